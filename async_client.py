@@ -0,0 +1,187 @@
+import asyncio
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtCore import QThread, pyqtSignal
+from image_source import StreamingImage
+from model import Mode, ModeRLI, RLI_DTYPES, PARAMS_FORMAT, pack_mode, unpack_params, frame_geo
+
+
+class AsyncRLIClient:
+    def __init__(self, host='127.0.0.1', port=9977, chunk_size=1024 * 1024):
+        self.host = host
+        self.port = port
+        self.chunk_size = chunk_size
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=self.chunk_size)
+        print(f"Connected to server at {self.host}:{self.port}")
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+
+    async def send_mode(self, mode_rli, x, y):
+        self.writer.write(pack_mode(Mode(mode_rli=mode_rli, size_x=x, size_y=y)))
+        await self.writer.drain()
+
+    async def receive_frame(self):
+        total_size = struct.unpack('=Q', await self.reader.readexactly(8))[0]
+        params = unpack_params(await self.reader.readexactly(struct.calcsize(PARAMS_FORMAT)))
+
+        frame = StreamingImage(params.size_x, total_size, RLI_DTYPES[params.mode_rli])
+        frame.params = params
+        while frame.bytes_received < total_size:
+            chunk = await self.reader.read(min(self.chunk_size, total_size - frame.bytes_received))
+            if not chunk:
+                raise ConnectionError("Connection terminated prematurely")
+            frame.write(chunk)
+        return params, frame
+
+
+class AsyncRLIEngine:
+    # Параллельный прием с нескольких серверов РЛИ. Каждый поток держит не больше
+    # max_inflight кадров (запрошенных и еще не обработанных), общая очередь
+    # к детектору ограничена queue_size.
+    def __init__(self, sources, size_x, size_y, mode=ModeRLI.CHAR, queue_size=4, max_inflight=2,
+                 max_backoff=30.0):
+        self.sources = list(sources)
+        self.size_x = size_x
+        self.size_y = size_y
+        self.mode = mode
+        self.queue_size = queue_size
+        self.max_inflight = max_inflight
+        self.max_backoff = max_backoff
+        self.stats = {f"{host}:{port}": {'frames': 0, 'bytes': 0} for host, port in self.sources}
+        self._loop = None
+        self._stop = None
+        # остановка может прийти из GUI раньше, чем run создаст цикл событий
+        self._stop_requested = threading.Event()
+        self._stop_lock = threading.Lock()
+
+    async def run(self, process):
+        # process(source, params, frame) выполняется в отдельном потоке, по одному кадру
+        stop = asyncio.Event()
+        with self._stop_lock:
+            self._stop = stop
+            self._loop = asyncio.get_running_loop()
+            if self._stop_requested.is_set():
+                stop.set()
+        queue = asyncio.Queue(self.queue_size)
+
+        streams = [asyncio.create_task(self._stream(host, port, queue)) for host, port in self.sources]
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            consumer = asyncio.create_task(self._consume(queue, process, executor))
+            await self._stop.wait()
+
+            for task in streams:
+                task.cancel()
+            await asyncio.gather(*streams, return_exceptions=True)
+            await queue.put(None)
+            await consumer
+
+    def stop(self):
+        with self._stop_lock:
+            self._stop_requested.set()
+            loop, stop = self._loop, self._stop
+        if loop is not None:
+            loop.call_soon_threadsafe(stop.set)
+
+    async def _stream(self, host, port, queue):
+        source = f"{host}:{port}"
+        inflight = asyncio.Semaphore(self.max_inflight)
+        backoff = 1.0
+
+        while not self._stop.is_set():
+            client = AsyncRLIClient(host, port)
+            requested = False
+            try:
+                await client.connect()
+
+                await inflight.acquire()
+                requested = True
+                await client.send_mode(self.mode, self.size_x, self.size_y)
+                while True:
+                    params, frame = await client.receive_frame()
+                    requested = False
+                    # задержка сбрасывается только после полученного кадра
+                    backoff = 1.0
+                    self.stats[source]['frames'] += 1
+                    self.stats[source]['bytes'] += frame.total_size
+
+                    await queue.put((source, params, frame, inflight))
+
+                    # следующий кадр запрашивается, пока текущий ждет детектор
+                    await inflight.acquire()
+                    requested = True
+                    await client.send_mode(self.mode, self.size_x, self.size_y)
+
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, struct.error, ValueError) as e:
+                print(f"{source}: {e}, retrying in {backoff:.0f} s")
+            finally:
+                if requested:
+                    inflight.release()
+                await client.close()
+
+            try:
+                await asyncio.wait_for(self._stop.wait(), backoff)
+            except asyncio.TimeoutError:
+                pass
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def _consume(self, queue, process, executor):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            source, params, frame, inflight = item
+            try:
+                await self._loop.run_in_executor(executor, process, source, params, frame)
+            except Exception as e:
+                print(f"{source}: error processing frame: {e}")
+            finally:
+                inflight.release()
+
+
+class AsyncSessionWorker(QThread):
+    file_processed = pyqtSignal(str, int)
+    geo_ready = pyqtSignal(str, object)
+    finished = pyqtSignal()
+    error = pyqtSignal(str)
+
+    def __init__(self, client, model, sources, size_x, size_y, conf):
+        super().__init__()
+        self.client = client
+        self.model = model
+        self.conf = conf
+        self.engine = AsyncRLIEngine(sources, size_x, size_y, mode=client.mode)
+
+    def stop(self):
+        self.engine.stop()
+
+    def run(self):
+        try:
+            asyncio.run(self.engine.run(self._process))
+        except Exception as e:
+            self.error.emit(f"Ошибка: {str(e)}")
+        finally:
+            self.finished.emit()
+
+    def _process(self, source, params, frame):
+        file_name = self.client.new_image_name()
+        self.client.archive_tiff(frame, file_name)
+        try:
+            _, detections = self.model.process_image(frame, self.conf, file_name)
+            geo = frame_geo(self.model, file_name, self.conf)
+            if geo is not None:
+                self.geo_ready.emit(file_name, geo)
+            self.file_processed.emit(file_name, detections)
+        except Exception as e:
+            self.error.emit(f"Ошибка обработки {file_name} ({source}): {str(e)}")
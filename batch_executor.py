@@ -0,0 +1,181 @@
+import os
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from image_source import open_image, image_params
+from profiling import ProcessingStats
+
+_processor = None
+
+
+def _init_process(processor, threads):
+    global _processor
+    import torch
+    torch.set_num_threads(threads)
+    _processor = processor
+
+
+def _process_in_child(image_path, conf):
+    filename = os.path.basename(image_path)
+    stats = ProcessingStats(filename)
+    _, detections = _processor.process_image(image_path, conf, filename, stats)
+    reports = getattr(_processor, 'reports', None)
+    report = reports.get(filename) if reports is not None else None
+    return detections, report, _processor.candidates.pop(filename, None), _processor.params.pop(filename, None), stats
+
+
+def _item_name(item):
+    # элемент - путь к файлу или пара (окно кадра, имя файла)
+    return item[1] if isinstance(item, tuple) else os.path.basename(item)
+
+
+def _load(item, stats):
+    if isinstance(item, tuple):
+        return item[0]
+    with stats.stage('decode'):
+        return open_image(item)
+
+
+class ProcessPool:
+    # Пул процессов с копией модели, живущий между запусками: веса в дочерних
+    # процессах загружаются один раз, кэш тайлов в их памяти сохраняется.
+    # Размер пула определяется при первом запросе, уже в рабочем потоке.
+    def __init__(self, processes=None, min_items=32):
+        self.processes = processes
+        self.min_items = min_items
+        self._pool = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    def get(self, model, items):
+        # для небольших каталогов запуск процессов дороже прогретой модели в основном процессе
+        if len(items) < self.min_items:
+            return None
+        with self._lock:
+            if self.processes is None:
+                self.processes = default_processes()
+            if self.processes <= 1:
+                return None
+            if self._pool is not None and self._model is not model:
+                self._shutdown()
+            if self._pool is None:
+                threads = max(1, (os.cpu_count() or 1) // self.processes)
+                context = multiprocessing.get_context('spawn')
+                self._pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=context,
+                                                 initializer=_init_process, initargs=(model, threads))
+                self._model = model
+            return self._pool
+
+    def shutdown(self):
+        with self._lock:
+            self._shutdown()
+
+    def _shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+            self._model = None
+
+
+class BatchDetector:
+    # Конвейер для каталога изображений: декодирование следующих файлов и
+    # сохранение результатов идут в пулах потоков параллельно с инференсом.
+    # На хостах без GPU большие каталоги можно обрабатывать файлами целиком в пуле процессов.
+    # Результаты выдаются в исходном порядке: (индекс, имя, кол-во объектов, ошибка, статистика).
+    def __init__(self, model, prefetch=2, writers=2, pool=None):
+        self.model = model
+        self.prefetch = prefetch
+        self.writers = writers
+        self.pool = pool
+
+    def run(self, items, conf):
+        if self.pool is not None and all(isinstance(item, str) for item in items):
+            pool = self.pool.get(self.model, items)
+            if pool is not None:
+                return self._run_processes(pool, items, conf)
+        return self._run_threads(items, conf)
+
+    def _run_threads(self, items, conf):
+        stats = [ProcessingStats(_item_name(item)) for item in items]
+        with ThreadPoolExecutor(max_workers=self.prefetch) as loader, \
+                ThreadPoolExecutor(max_workers=self.writers) as writer:
+            loads = deque(loader.submit(_load, item, stats[i]) for i, item in enumerate(items[:self.prefetch]))
+            next_item = len(loads)
+            saves = deque()
+
+            for i, item in enumerate(items):
+                load = loads.popleft()
+                if next_item < len(items):
+                    loads.append(loader.submit(_load, items[next_item], stats[next_item]))
+                    next_item += 1
+
+                filename = _item_name(item)
+                try:
+                    image = load.result()
+                    params = image_params(item if isinstance(item, str) else image)
+                    if params is not None:
+                        self.model.params[filename] = params
+                    self.model.candidates[filename] = self.model.detect_candidates(image, conf, stats[i])
+                    detections = self.model.rethreshold(filename, conf)
+                    future = None
+                    if self.model.save_images:
+                        future = writer.submit(self.model.save_result, image, detections, filename, stats[i])
+                    saves.append((i, filename, future, self.model.count_detections(detections), None, stats[i]))
+                except Exception as e:
+                    saves.append((i, filename, None, None, e, stats[i]))
+
+                # не держим в памяти больше готовых изображений, чем успевает записать пул
+                while saves and (saves[0][2] is None or saves[0][2].done() or len(saves) > 2 * self.writers):
+                    yield self._finish(saves.popleft())
+
+            while saves:
+                yield self._finish(saves.popleft())
+
+    def _finish(self, save):
+        i, filename, future, count, error, stats = save
+        if future is not None:
+            try:
+                future.result()
+            except Exception as e:
+                return i, filename, None, e, stats
+        return i, filename, count, error, stats
+
+    def _run_processes(self, pool, paths, conf):
+        try:
+            futures = [pool.submit(_process_in_child, path, conf) for path in paths]
+        except BrokenProcessPool:
+            self.pool.shutdown()
+            raise
+        try:
+            for i, (path, future) in enumerate(zip(paths, futures)):
+                filename = os.path.basename(path)
+                try:
+                    detections, report, candidates, params, stats = future.result()
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        # упавший пул пересоздается при следующем запуске
+                        self.pool.shutdown()
+                    yield i, filename, None, e, ProcessingStats(filename)
+                    continue
+                if report is not None:
+                    self.model.reports[filename] = report
+                if candidates is not None:
+                    self.model.candidates[filename] = candidates
+                if params is not None:
+                    self.model.params[filename] = params
+                yield i, filename, detections, None, stats
+        finally:
+            # пул переживает запуск - недоделанные файлы прерванного запуска отменяются
+            for future in futures:
+                future.cancel()
+
+
+def default_processes():
+    # пул процессов имеет смысл только без GPU и при нескольких ядрах
+    import torch
+    if torch.cuda.is_available():
+        return 0
+    processes = min(4, (os.cpu_count() or 1) // 2)
+    return processes if processes > 1 else 0
@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import tracemalloc
+from datetime import datetime
+import numpy as np
+from tiled_processor import TiledYOLOProcessor
+
+
+class StubBoxes:
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = xyxy
+        self.conf = conf
+        self.cls = cls
+
+    def __len__(self):
+        return len(self.xyxy)
+
+
+class StubResult:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class StubModel:
+    # Заменяет YOLO: на каждый тайл возвращает одни и те же боксы на сетке,
+    # поэтому замеры постобработки воспроизводимы и не требуют весов.
+    names = {0: 'object'}
+
+    def __init__(self, boxes_per_tile=8, box_size=24):
+        self.boxes_per_tile = boxes_per_tile
+        self.box_size = box_size
+
+    def __call__(self, images, imgsz=None, conf=0.25, verbose=True):
+        import torch
+
+        results = []
+        for image in images:
+            height, width = image.shape[:2]
+            side = int(np.ceil(np.sqrt(self.boxes_per_tile)))
+            xs = (np.arange(self.boxes_per_tile) % side + 0.5) * width / side
+            ys = (np.arange(self.boxes_per_tile) // side + 0.5) * height / side
+            half = self.box_size / 2
+            xyxy = np.stack([xs - half, ys - half, xs + half, ys + half], axis=1).clip(0, [width, height, width, height])
+            scores = np.linspace(0.9, 0.3, self.boxes_per_tile)
+            results.append(StubResult(StubBoxes(
+                torch.tensor(xyxy, dtype=torch.float32),
+                torch.tensor(scores, dtype=torch.float32),
+                torch.zeros(self.boxes_per_tile, dtype=torch.float32))))
+        return results
+
+
+def synthetic_image(width, height, channels=1, seed=0):
+    rng = np.random.default_rng(seed)
+    shape = (height, width) if channels == 1 else (height, width, channels)
+    return rng.integers(0, 64, shape, dtype=np.uint8)
+
+
+def synthetic_boxes(count, width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, [width, height], (count, 2))
+    wh = rng.uniform(8, 64, (count, 2))
+    boxes = np.hstack([xy, xy + wh]).astype(np.float32)
+    return boxes, rng.uniform(0.25, 1.0, count).astype(np.float32), rng.integers(0, 3, count).astype(np.float32)
+
+
+def measure(func, repeat):
+    # время без tracemalloc (он сильно замедляет Python-код), пик памяти - отдельным прогоном
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = np.array(times) * 1000
+    return {
+        'repeat': repeat,
+        'mean_ms': float(times.mean()),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p90_ms': float(np.percentile(times, 90)),
+        'p99_ms': float(np.percentile(times, 99)),
+        'peak_mb': peak / 2 ** 20,
+    }
+
+
+def stub_processor(tile_size, overlap, batch_size, nms_grid=False):
+    processor = TiledYOLOProcessor('stub', tile_size=tile_size, imgsz=tile_size, overlap=overlap,
+                                   batch_size=batch_size, nms_grid=nms_grid)
+    processor._model = StubModel()
+    return processor
+
+
+def bench_tiling(args, results):
+    image = synthetic_image(args.width, args.height)
+    processor = stub_processor(args.tile_size, args.overlap, args.batch_size)
+
+    results['generate_tiles'] = measure(lambda: processor._generate_tiles(args.width, args.height), args.repeat)
+
+    tiles = processor._generate_tiles(args.width, args.height)
+    tile_shape = (min(args.tile_size, args.height), min(args.tile_size, args.width), 3)
+
+    def crop():
+        for i in range(0, len(tiles), processor.batch_size):
+            batch = tiles[i:i + processor.batch_size]
+            buffer = processor._get_batch_buffer(len(batch), tile_shape)
+            for k, (x1, y1, x2, y2) in enumerate(batch):
+                buffer[k] = image[y1:y2, x1:x2, None]
+
+    results['tile_crop'] = measure(crop, args.repeat)
+    results['tile_crop']['tiles'] = len(tiles)
+    results['detect_stub'] = measure(lambda: processor.detect(image, args.conf), args.repeat)
+
+
+def bench_nms(args, results):
+    for count in args.boxes:
+        boxes, scores, classes = synthetic_boxes(count, args.width, args.height)
+        for grid in (False, True):
+            name = f"nms_{'grid' if grid else 'greedy'}_{count}"
+            if not grid and count > args.greedy_limit:
+                print(f"{name}: пропущен (больше --greedy-limit)")
+                continue
+            processor = stub_processor(args.tile_size, args.overlap, args.batch_size, nms_grid=grid)
+            results[name] = measure(lambda: processor._filter_overlapping_boxes(boxes, scores, classes),
+                                    max(1, args.repeat // 5) if count >= 10000 else args.repeat)
+
+
+def bench_raw_to_tiff(args, results, workdir):
+    from model import RLIClient, ModeRLI
+
+    raw_file = os.path.join(workdir, 'bench.raw')
+    synthetic_image(args.width, args.height).astype(np.uint16).tofile(raw_file)
+    os.makedirs(os.path.join(workdir, 'client_image'), exist_ok=True)
+
+    client = RLIClient()
+    results['raw_to_tiff'] = measure(
+        lambda: client.raw_to_tiff(raw_file, raw_file + '.tiff', args.width, ModeRLI.USHORT), args.repeat)
+
+
+def bench_receive(args, results):
+    from model import RLIClient, ModeRLI
+    from mock_rli_server import MockRLIServer
+
+    loop = asyncio.new_event_loop()
+    server = MockRLIServer(port=0)
+    loop.run_until_complete(server.start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    client = RLIClient('127.0.0.1', server.port)
+    client.set_mode(ModeRLI.UCHAR)
+    client.connect()
+
+    def receive():
+        client.send_mode(args.width, args.height)
+        client.receive_stream()
+
+    try:
+        results['rli_receive'] = measure(receive, args.repeat)
+        frame_mb = args.width * args.height / 2 ** 20
+        results['rli_receive']['mb_per_s'] = frame_mb / (results['rli_receive']['p50_ms'] / 1000)
+    finally:
+        client.disconnect()
+        loop.call_soon_threadsafe(loop.stop)
+
+
+def compare(results, previous_path):
+    with open(previous_path, encoding='utf-8') as f:
+        previous = json.load(f)['stages']
+    print(f"\nСравнение с {previous_path} (p50):")
+    for stage, current in results.items():
+        if stage in previous:
+            before = previous[stage]['p50_ms']
+            change = (current['p50_ms'] - before) / before * 100 if before else 0.0
+            print(f"  {stage:<28} {before:10.2f} -> {current['p50_ms']:10.2f} ms  ({change:+.1f}%)")
+
+
+def print_results(results):
+    print(f"{'stage':<28} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} {'peak MB':>10}")
+    for stage, stats in results.items():
+        print(f"{stage:<28} {stats['p50_ms']:10.2f} {stats['p90_ms']:10.2f} {stats['p99_ms']:10.2f} "
+              f"{stats['peak_mb']:10.1f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры производительности тайлинга и постобработки")
+    parser.add_argument('--width', type=int, default=8192)
+    parser.add_argument('--height', type=int, default=4096)
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--overlap', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--boxes', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--greedy-limit', type=int, default=20000,
+                        help="не запускать NMS без сетки на большем числе боксов")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--stages', nargs='+', default=['tiling', 'nms', 'raw_to_tiff', 'receive'],
+                        choices=['tiling', 'nms', 'raw_to_tiff', 'receive'])
+    parser.add_argument('--save', help="сохранить результаты в JSON")
+    parser.add_argument('--compare', help="JSON предыдущего запуска для сравнения")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        if 'tiling' in args.stages:
+            bench_tiling(args, results)
+        if 'nms' in args.stages:
+            bench_nms(args, results)
+        if 'raw_to_tiff' in args.stages:
+            bench_raw_to_tiff(args, results, workdir)
+        if 'receive' in args.stages:
+            bench_receive(args, results)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    if args.compare:
+        compare(results, args.compare)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'platform': platform.platform(),
+                'python': sys.version.split()[0],
+                'args': vars(args),
+                'stages': results,
+            }, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import os
+import csv
+import json
+import time
+import argparse
+from image_source import open_image, read_params
+from tiled_processor import TiledYOLOProcessor, MODEL_PRESETS
+from multi_model import MultiModelProcessor
+from profiling import ProcessingStats, write_chrome_trace
+from tile_cache import TileCache
+from tile_filter import TileFilter
+from detection_store import DetectionStore
+from georef import detections_to_geo
+
+# короткие имена моделей для командной строки, как у переключателей в интерфейсе
+MODEL_ALIASES = {
+    'vvkr': "наземные объекты",
+    'ships': "большие надводные объекты",
+    'bkr': "малые надводные объекты",
+}
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tif", ".tiff"}
+
+CSV_FIELDS = ['image', 'model', 'x1', 'y1', 'x2', 'y2', 'conf', 'cls', 'name', 'lat', 'lon']
+
+
+class DetectionWriter:
+    def __init__(self, path, fmt):
+        self.format = fmt
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        if fmt == 'csv':
+            self.writer = csv.DictWriter(self.file, fieldnames=CSV_FIELDS)
+            self.writer.writeheader()
+
+    def write(self, image_name, model_name, names, detections, params=None):
+        # координаты центров всех боксов кадра считаются одним вызовом
+        geo = detections_to_geo(detections, params).tolist() if params is not None else None
+        for k, (x1, y1, x2, y2, conf, cls) in enumerate(detections.tolist()):
+            record = {
+                'image': image_name, 'model': model_name,
+                'x1': round(x1, 2), 'y1': round(y1, 2), 'x2': round(x2, 2), 'y2': round(y2, 2),
+                'conf': round(conf, 4), 'cls': int(cls), 'name': names[int(cls)],
+                'lat': round(geo[k][0], 7) if geo else None, 'lon': round(geo[k][1], 7) if geo else None,
+            }
+            if self.format == 'csv':
+                self.writer.writerow(record)
+            else:
+                self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class StageTimer:
+    def __init__(self):
+        self.totals = {}
+        self.counters = {}
+        self.stats = []
+        self.images = 0
+        self.started = time.perf_counter()
+
+    def add(self, stage, seconds):
+        self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+
+    def add_stats(self, stats):
+        self.stats.append(stats)
+        for stage, seconds in stats.stages.items():
+            self.add(stage, seconds)
+        for name, value in stats.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        print(f"Изображений: {self.images}, время: {elapsed:.2f} s, "
+              f"{self.images / elapsed if elapsed > 0 else 0.0:.2f} img/s")
+        for stage, total in self.totals.items():
+            per_image = total / self.images if self.images else 0.0
+            print(f"  {stage:<10} {total:9.3f} s  {per_image * 1000:9.1f} ms/img")
+        if self.counters:
+            print("  " + ", ".join(f"{name} {value}" for name, value in self.counters.items()))
+        if self.counters.get('tiles_skipped'):
+            print(f"  пропущено тайлов: {self.counters['tiles_skipped'] / self.counters['tiles']:.1%}")
+
+
+def build_processor(model_name, batch_size, **options):
+    if model_name == 'all':
+        return MultiModelProcessor({
+            name: TiledYOLOProcessor(**preset, batch_size=batch_size, **options)
+            for name, preset in MODEL_PRESETS.items()
+        })
+    name = MODEL_ALIASES.get(model_name, model_name)
+    return {name: TiledYOLOProcessor(**MODEL_PRESETS[name], batch_size=batch_size, **options)}
+
+
+def directory_frames(directory):
+    for file in sorted(os.listdir(directory)):
+        if os.path.splitext(file)[1].lower() not in IMAGE_EXTENSIONS:
+            continue
+        path = os.path.join(directory, file)
+        stats = ProcessingStats(file)
+        with stats.stage('decode'):
+            image = open_image(path)
+        yield image, file, stats, read_params(path)
+
+
+def rli_frames(address, size_x, size_y, frames):
+    from model import RLIClient
+
+    host, _, port = address.partition(':')
+    client = RLIClient(host, int(port or 9977))
+    if not client.connect():
+        raise SystemExit("Не удалось подключиться к серверу")
+    try:
+        for _ in range(frames):
+            stats = ProcessingStats()
+            if not client.send_mode(size_x, size_y):
+                raise SystemExit("Ошибка отправки параметров")
+            received = client.receive_stream(stats=stats)
+            if not received:
+                raise SystemExit("Ошибка получения данных")
+            stats.name = client.new_image_name()
+            yield received[1], stats.name, stats, received[0]
+    finally:
+        client.disconnect()
+
+
+def run(args):
+    cache = TileCache(args.cache) if args.cache else None
+    tile_filter = TileFilter(cfar_k=args.skip_empty) if args.skip_empty else None
+    cascade = None
+    if args.cascade:
+        cascade_preset = MODEL_PRESETS[MODEL_ALIASES.get(args.cascade, args.cascade)]
+        cascade = TiledYOLOProcessor(**cascade_preset, batch_size=args.batch_size, cache=cache)
+    processor = build_processor(args.model, args.batch_size, cache=cache, tile_filter=tile_filter,
+                                cascade=cascade, cascade_scale=args.cascade_scale)
+    processors = processor.processors if isinstance(processor, MultiModelProcessor) else processor
+    timer = StageTimer()
+    writer = DetectionWriter(args.output, args.format)
+    store = DetectionStore(args.store) if args.store else None
+
+    if args.rli:
+        frames = rli_frames(args.rli, args.size_x, args.size_y, args.frames)
+    else:
+        frames = directory_frames(args.input)
+
+    try:
+        for image, image_name, stats, params in frames:
+            if isinstance(processor, MultiModelProcessor):
+                detections = processor.detect(image, args.conf, stats)
+            else:
+                detections = {name: p.detect(image, args.conf, stats) for name, p in processors.items()}
+
+            with stats.stage('write'):
+                for name, dets in detections.items():
+                    writer.write(image_name, name, processors[name].model.names, dets, params)
+                    if store is not None:
+                        store.add(image_name, name, dets, params,
+                                  None if args.rli else os.path.join(args.input, image_name))
+            if args.save_images:
+                if isinstance(processor, MultiModelProcessor):
+                    processor.save_result(image, detections, image_name, stats)
+                else:
+                    for name, dets in detections.items():
+                        processors[name].save_result(image, dets, image_name, stats)
+
+            timer.add_stats(stats)
+            timer.images += 1
+            count = sum(len(dets) for dets in detections.values())
+            print(f"{image_name}: {count} объектов")
+    finally:
+        writer.close()
+        if store is not None:
+            store.flush()
+        timer.report()
+        if args.trace:
+            write_chrome_trace(args.trace, timer.stats)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетная детекция без графического интерфейса")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--input', help="каталог с изображениями")
+    source.add_argument('--rli', help="сервер РЛИ host[:port]")
+    parser.add_argument('--model', default='vvkr',
+                        choices=list(MODEL_ALIASES) + list(MODEL_PRESETS) + ['all'])
+    parser.add_argument('--conf', type=float, default=0.5)
+    parser.add_argument('--batch-size', default='auto',
+                        type=lambda value: value if value == 'auto' else int(value))
+    parser.add_argument('--output', default='detections.jsonl')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default=None,
+                        help="по умолчанию - по расширению --output")
+    parser.add_argument('--save-images', action='store_true', help="сохранять размеченные изображения в tmp/")
+    parser.add_argument('--size-x', type=int, default=8192)
+    parser.add_argument('--size-y', type=int, default=1024)
+    parser.add_argument('--frames', type=int, default=1, help="сколько кадров запросить у сервера РЛИ")
+    parser.add_argument('--cache', help="каталог кэша предсказаний по тайлам")
+    parser.add_argument('--skip-empty', type=float, nargs='?', const=5.0, default=None, metavar='K',
+                        help="пропускать однородные тайлы без выбросов ярче фона на K СКО (по умолчанию 5)")
+    parser.add_argument('--cascade', choices=list(MODEL_ALIASES) + list(MODEL_PRESETS),
+                        help="модель грубого прохода по прореженному изображению; "
+                             "основная модель работает только в найденных областях")
+    parser.add_argument('--cascade-scale', type=int, default=4, help="прореживание для грубого прохода")
+    parser.add_argument('--store', help="каталог хранилища детекций с пространственным индексом")
+    parser.add_argument('--trace', help="сохранить этапы обработки в JSON для chrome://tracing")
+    args = parser.parse_args(argv)
+    if args.format is None:
+        args.format = 'csv' if args.output.lower().endswith('.csv') else 'jsonl'
+    return args
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -1,24 +1,57 @@
-import os, shutil
+import os
 from pathlib import Path
+import numpy as np
+from PyQt5.QtCore import QTimer, QCoreApplication
 from PyQt5.QtWidgets import QFileDialog, QMessageBox
-from model import RLIClient, ImageProcessingWorker, ImageFetchWorker
+from model import RLIClient, ImageProcessingWorker, ImageFetchWorker, StreamingDetectionWorker, \
+    RLISessionWorker, ExportWorker
+from async_client import AsyncSessionWorker
 from view import MainWindow
-from tiled_processor import TiledYOLOProcessor  
+from tiled_processor import TiledYOLOProcessor, MODEL_PRESETS
+from multi_model import MultiModelProcessor
+from batch_executor import ProcessPool
+from profiling import write_chrome_trace
+from tile_cache import TileCache
+from detection_store import DetectionStore
 
 
 class AppController:
     def __init__(self, view: MainWindow):
         self.view = view
         self.client = RLIClient()
+        # список снимков обновляется, когда фоновая запись кадра в TIFF закончена
+        self.client.file_archived.connect(self.on_file_archived)
+        # предсказания тайлов переиспользуются при повторных запусках и смене порога
+        self.tile_cache = TileCache()
         self.models = {
-            "наземные объекты": TiledYOLOProcessor('weights/nano960-9.pt', tile_size=4000, imgsz=960, overlap=100),
-            "большие надводные объекты": TiledYOLOProcessor('weights/medium_ships.pt', tile_size=800, imgsz=800, overlap=100),
-            "малые надводные объекты": TiledYOLOProcessor('weights/bkr.pt', tile_size=256, imgsz=256, overlap=50),
+            name: TiledYOLOProcessor(**preset, batch_size='auto', cache=self.tile_cache)
+            for name, preset in MODEL_PRESETS.items()
         }
-        self.model = self.models["наземные объекты"]
+        # рамки рисуются поверх исходного изображения, размеченные копии - только при сохранении
+        for model in self.models.values():
+            model.save_images = False
+        self.selected_model = self.models["наземные объекты"]
+        self.model = self.selected_model
+        self.combined_model = MultiModelProcessor(self.models)
+        self.combined_model.save_images = False
         self.conf = self.view.horizontalSlider.value() / 100
         self.image_files = []
+        self.session_worker = None
+        self.stats = []
+        self.current_image = None
+        self.export_worker = None
+        # кандидаты всех обработанных снимков сохраняются на диск для последующих запросов
+        self.store = DetectionStore()
+        # географические координаты детекций по кадрам с параметрами РЛИ
+        self.geo = {}
+        QCoreApplication.instance().aboutToQuit.connect(self.store.flush)
+        QCoreApplication.instance().aboutToQuit.connect(self.client.wait_archived)
+        # пул процессов для больших каталогов на хостах без GPU, один на все запуски
+        self.process_pool = ProcessPool()
+        QCoreApplication.instance().aboutToQuit.connect(self.process_pool.shutdown)
         self._connect_signals()
+        # веса загружаются лениво; выбранную модель прогреваем в фоне после показа окна
+        QTimer.singleShot(0, self.model.warm_up_async)
 
     def _connect_signals(self):
         self.view.detect_btn_2.clicked.connect(self.detect_clicked)
@@ -27,17 +60,33 @@ class AppController:
         self.view.start_btn.clicked.connect(self.start_client)
         self.view.horizontalSlider.valueChanged.connect(self.update_conf)
         self.view.buttonGroup.buttonClicked.connect(self.update_model)
+        self.view.all_models_chbox.toggled.connect(self.update_combined_mode)
         self.view.detected_chbox.clicked.connect(self.view.toggle_image_mode)
+        self.view.detected_chbox.clicked.connect(self.update_overlay)
         self.view.tableWidget.image_changes.connect(self.show_image)
         self.client.receive_data_percent.connect(self.view.update_progress)
 
     def start_client(self):
+        if self.session_worker is not None:
+            self.view.start_btn.setEnabled(False)
+            self.view.statusBar().showMessage("Остановка приема...")
+            self.session_worker.stop()
+            return
+
         try:
             self.view.set_ui_enabled(False)
             self.view.progress_bar.setVisible(True)
             self.view.progress_bar.setValue(0)
             self.view.statusBar().showMessage("Подключение к серверу...")
 
+            if self.view.session_chbox.isChecked():
+                self.start_session()
+                return
+
+            if self.view.stream_chbox.isChecked():
+                self.start_streaming()
+                return
+
             self.fetch_worker = ImageFetchWorker(
                 self.client,
                 self.view.host_label.text(),
@@ -46,7 +95,7 @@ class AppController:
                 int(self.view.size_y_label.text())
             )
 
-            self.fetch_worker.finished.connect(self.on_fetch_finished)
+            self.fetch_worker.frame_received.connect(self.on_fetch_finished)
             self.fetch_worker.finished.connect(self.cleanup_worker)
             self.fetch_worker.error.connect(self.view.show_error)
 
@@ -58,15 +107,92 @@ class AppController:
             self.view.set_ui_enabled(True)
             self.view.progress_bar.setVisible(False)
 
-    def on_fetch_finished(self, file_name):
+    def start_streaming(self):
+        self.stream_worker = StreamingDetectionWorker(
+            self.client,
+            self.model,
+            self.view.host_label.text(),
+            int(self.view.port_label.text()),
+            int(self.view.size_x_label.text()),
+            int(self.view.size_y_label.text()),
+            self.conf
+        )
+
+        self.stream_worker.file_processed.connect(self.on_frame_processed)
+        self.stream_worker.geo_ready.connect(self.on_geo_ready)
+        self.stream_worker.stats_ready.connect(self.on_stats_ready)
+        self.stream_worker.finished.connect(self.on_client_processing_finished)
+        self.stream_worker.error.connect(self.view.show_error)
+        self.stream_worker.error.connect(self.on_client_processing_finished)
+
+        self.stream_worker.finished.connect(self.stream_worker.deleteLater)
+        self.stream_worker.start()
+
+    def start_session(self):
+        sources = self._parse_sources()
+        if len(sources) > 1:
+            self.session_worker = AsyncSessionWorker(
+                self.client,
+                self.model,
+                sources,
+                int(self.view.size_x_label.text()),
+                int(self.view.size_y_label.text()),
+                self.conf
+            )
+        else:
+            host, port = sources[0]
+            self.session_worker = RLISessionWorker(
+                self.client,
+                self.model,
+                host,
+                port,
+                int(self.view.size_x_label.text()),
+                int(self.view.size_y_label.text()),
+                self.conf
+            )
+
+        self.session_worker.file_processed.connect(self.on_session_frame_processed)
+        self.session_worker.geo_ready.connect(self.on_geo_ready)
+        self.session_worker.error.connect(lambda msg: self.view.statusBar().showMessage(msg, 5000))
+        self.session_worker.finished.connect(self.on_session_finished)
+        self.session_worker.start()
+
+        self.view.start_btn.setText("Stop")
+        self.view.start_btn.setEnabled(True)
+
+    def _parse_sources(self):
+        # в поле хоста можно перечислить несколько серверов: "host[:port], host[:port]"
+        default_port = int(self.view.port_label.text())
+        sources = []
+        for entry in self.view.host_label.text().split(','):
+            host, _, port = entry.strip().partition(':')
+            if host:
+                sources.append((host, int(port) if port else default_port))
+        return sources
+
+    def on_session_frame_processed(self, file_name, detections):
+        self.on_frame_processed(file_name, detections)
+
+    def on_file_archived(self, file_name):
+        self.image_files = self.view.get_images_in_directory(os.getcwd() + '/client_image/')
+
+    def on_session_finished(self):
+        self.session_worker.deleteLater()
+        self.session_worker = None
+        self.view.start_btn.setText("Load")
+        self.on_client_processing_finished()
+
+    def on_fetch_finished(self, frame, file_name):
         self.view.statusBar().showMessage("Обработка изображения...")
 
         self.worker = ImageProcessingWorker(
             self.model,
-            [f'client_image/{file_name}'],
+            [(frame, file_name)],
             self.conf
         )
-        self.worker.file_processed.connect(lambda f, d: self.view.tableWidget.add_row(f, d))
+        self.worker.file_processed.connect(self.on_frame_processed)
+        self.worker.geo_ready.connect(self.on_geo_ready)
+        self.worker.stats_ready.connect(self.on_stats_ready)
         self.worker.finished.connect(self.on_client_processing_finished)
         self.worker.finished.connect(self.worker.deleteLater)
         self.worker.start()
@@ -96,14 +222,16 @@ class AppController:
             params, raw_file = result
 
             tiff_file = Path(raw_file).with_suffix('.tiff')
-            file_name = self.client.raw_to_tiff(raw_file, str(tiff_file), params.size_x, params.mode_rli)
+            file_name = self.client.raw_to_tiff(raw_file, str(tiff_file), params.size_x, params.mode_rli, params)
             if not file_name:
                 self.view.show_error("Ошибка конвертации")
                 return
 
 
             worker = ImageProcessingWorker(self.model, [f'client_image/{file_name}'], self.conf)
-            worker.file_processed.connect(lambda f, d: self.view.tableWidget.add_row(f, d))
+            worker.file_processed.connect(self.on_frame_processed)
+            worker.geo_ready.connect(self.on_geo_ready)
+            worker.stats_ready.connect(self.on_stats_ready)
             worker.finished.connect(self.on_client_processing_finished)
             worker.start()
         finally:
@@ -115,6 +243,8 @@ class AppController:
         self.view.set_ui_enabled(True)
         self.view.progress_bar.setVisible(False)
         self.view.statusBar().showMessage("Готово", 3000)
+        self.store.flush()
+        self.write_trace()
 
     def detect_clicked(self):
         if not hasattr(self, 'image_files') or not self.image_files:
@@ -127,11 +257,14 @@ class AppController:
         self.current_worker = ImageProcessingWorker(
             self.model, 
             self.image_files, 
-            self.conf
+            self.conf,
+            self.process_pool
         )
 
         self.current_worker.progress_updated.connect(self.view.update_progress)
-        self.current_worker.file_processed.connect(self.view.tableWidget.update_value)
+        self.current_worker.file_processed.connect(self.on_file_processed)
+        self.current_worker.geo_ready.connect(self.on_geo_ready)
+        self.current_worker.stats_ready.connect(self.on_stats_ready)
         self.current_worker.finished.connect(self.on_processing_finished)
         self.current_worker.error_occurred.connect(self.view.show_error)
 
@@ -147,28 +280,150 @@ class AppController:
         self.view.set_ui_enabled(True)
         self.view.progress_bar.setVisible(False)
         self.view.statusBar().showMessage("Обработка завершена", 3000)
+        self.store.flush()
+        self.write_trace()
+
+    def on_stats_ready(self, stats):
+        self.stats.append(stats)
+        print(stats.summary())
+        self.view.statusBar().showMessage(stats.summary(), 5000)
+
+    def write_trace(self):
+        # DETECTION_TRACE=trace.json - сохранить этапы обработки для chrome://tracing
+        path = os.environ.get('DETECTION_TRACE')
+        if path and self.stats:
+            write_chrome_trace(path, self.stats)
+        self.stats = []
 
     def save_file(self):
         directory = QFileDialog.getExistingDirectory(self.view, "Выберите директорию", "")
-        if directory:
-            for file in os.listdir('tmp'):
-                shutil.copy2(f'tmp/{file}', directory)
+        if not directory:
+            return
+        items = [(self._image_path(name), name) for name in self.model.candidates if self._image_path(name)]
+        if not items:
+            self.view.show_error("Нет результатов детекции для сохранения")
+            return
+
+        self.view.set_ui_enabled(False)
+        self.view.progress_bar.setVisible(True)
+        self.view.progress_bar.setValue(0)
+
+        self.export_worker = ExportWorker(self.model, items, self.conf, directory)
+        self.export_worker.progress_updated.connect(self.view.update_progress)
+        self.export_worker.error_occurred.connect(self.view.show_error)
+        self.export_worker.finished.connect(self.on_processing_finished)
+        self.export_worker.finished.connect(self.export_worker.deleteLater)
+        self.export_worker.start()
 
     def show_image(self, msg):
-        if self.view.image_mode_detected:
+        self.current_image = msg
+        path = self._image_path(msg)
+        if path:
+            self.view.graphicsView.set_image(path)
+            self.update_overlay()
+        elif self.view.image_mode_detected and os.path.exists(f'tmp/detected_{msg}'):
             self.view.graphicsView.set_image(f'tmp/detected_{msg}')
+
+    def update_overlay(self):
+        # рамки из сохраненных кандидатов поверх уже показанного изображения
+        if self.view.image_mode_detected and self.current_image in self.model.candidates:
+            detections = self.model.rethreshold(self.current_image, self.conf)
+            self.view.graphicsView.set_detections(self.model.detection_groups(detections))
         else:
-            for name in self.image_files:
-                if name.endswith(msg):
-                    self.view.graphicsView.set_image(name)
-                    return
+            self.view.graphicsView.clear_detections()
+
+    def _image_path(self, file_name):
+        for name in self.image_files:
+            if os.path.basename(name) == file_name:
+                return name
+        return None
 
     def update_model(self, btn):
-        self.model = self.models.get(btn.text(), self.model)
+        self.selected_model = self.models.get(btn.text(), self.selected_model)
+        if not self.view.all_models_chbox.isChecked():
+            self.model = self.selected_model
+        if not self.selected_model.loaded:
+            self.selected_model.warm_up_async()
+
+    def update_combined_mode(self, checked):
+        self.model = self.combined_model if checked else self.selected_model
+        if checked:
+            for model in self.models.values():
+                if not model.loaded:
+                    model.warm_up_async()
+        for btn in self.view.buttonGroup.buttons():
+            btn.setEnabled(not checked)
+
+    def on_frame_processed(self, file_name, detections):
+        self.view.tableWidget.add_row(file_name, detections)
+        self.store_detections(file_name)
+
+    def store_detections(self, file_name, params=None):
+        candidates = self.model.candidates.get(file_name)
+        if candidates is None:
+            return
+        if params is None:
+            params = self.model.params.get(file_name)
+        if not isinstance(candidates, dict):
+            candidates = {self._model_name(self.model): candidates}
+        # кадры РЛИ архивируются в client_image под своим именем
+        path = self._image_path(file_name) or os.path.join('client_image', file_name)
+        for name, detections in candidates.items():
+            self.store.add(file_name, name, detections, params, path)
+
+    def _model_name(self, model):
+        return next(name for name, processor in self.models.items() if processor is model)
+
+    def on_file_processed(self, file_name, detections):
+        self.store_detections(file_name)
+        self.update_row(file_name, detections)
+
+    def on_geo_ready(self, file_name, geo):
+        self.geo[file_name] = geo
+        # координаты хранятся только для кадров, кандидаты которых еще не вытеснены
+        for name in [name for name in self.geo if name not in self.model.candidates]:
+            del self.geo[name]
+
+    def update_row(self, file_name, detections):
+        details = ""
+        if self.model is self.combined_model:
+            details = self.combined_model.report_text(file_name)
+        coordinates = self.geo_text(file_name)
+        if coordinates:
+            details = f"{details}\n{coordinates}" if details else coordinates
+        self.view.tableWidget.update_value(file_name, detections, details)
+
+    def geo_text(self, file_name, limit=10):
+        # координаты центров первых объектов для подсказки в таблице
+        geo = self.geo.get(file_name)
+        if geo is None:
+            return ""
+        if isinstance(geo, dict):
+            geo = np.concatenate(list(geo.values())) if geo else np.empty((0, 4))
+        lines = [f"{lat:.6f}, {lon:.6f}" for lat, lon, _, _ in geo[:limit].tolist()]
+        if len(geo) > limit:
+            lines.append(f"... и еще {len(geo) - limit}")
+        return "\n".join(["Координаты:"] + lines) if lines else ""
 
     def update_conf(self, value):
         self.conf = value / 100
         self.view.slider_lbl_2.setText(f"Порог доверия: {value / 100}")
+        self.apply_threshold()
+
+    def apply_threshold(self):
+        # новый порог применяется к сохраненным кандидатам, без повторного инференса
+        if not self.model.candidates:
+            return
+        if self.conf < self.model.floor_conf:
+            self.view.statusBar().showMessage(
+                f"Кандидаты сохранены с порогом {self.model.floor_conf}: "
+                f"для меньшего порога запустите детекцию заново", 5000)
+        for file_name in list(self.model.candidates):
+            detections = self.model.rethreshold(file_name, self.conf)
+            if file_name in self.geo:
+                self.geo[file_name] = self.model.georeference(file_name, detections)
+            self.update_row(file_name, self.model.count_detections(detections))
+        self.update_overlay()
 
     def select_directory(self):
         directory = QFileDialog.getExistingDirectory(self.view, "Выберите директорию", "")
@@ -178,5 +433,9 @@ class AppController:
             self.view.detected_chbox.setChecked(False)
             self.view.image_mode_detected = False
             self.image_files = self.view.get_images_in_directory(directory)
+            # вместе с кандидатами очищаются параметры кадров и отчеты
+            for model in list(self.models.values()) + [self.combined_model]:
+                model.candidates.clear()
+            self.geo.clear()
             self.view.tableWidget.fill_table([os.path.basename(f) for f in self.image_files])
             self.view.detected_chbox.setEnabled(False)
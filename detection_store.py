@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from georef import GEO_FIELDS, pixel_to_geo
+
+COLUMNS = {
+    'boxes': np.float32,
+    'conf': np.float16,
+    'cls': np.uint16,
+    'model': np.uint8,
+    'image': np.uint32,
+    'key': np.int64,
+}
+
+CELL_BITS = 20
+
+
+class DetectionSegment:
+    # Один сегмент хранилища: столбцы детекций в .npy (открываются через memmap),
+    # отсортированные по ключу (изображение, ячейка сетки по центру бокса),
+    # и метаданные изображений с параметрами РЛИ.
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        self.images = meta['images']
+        self.models = meta['models']
+        self.entries = meta['entries']
+        self.cell = meta['cell']
+        self.margin = meta['margin']
+        self.params = np.load(os.path.join(path, 'params.npy'))
+        self.columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in COLUMNS}
+
+    def rows(self, image_ids, region=None):
+        # номера строк снимков image_ids; с region - только из ячеек сетки, которые
+        # могут содержать боксы, пересекающие область
+        key = self.columns['key']
+        base = np.asarray(image_ids, dtype=np.int64) << (2 * CELL_BITS)
+        if region is None:
+            starts, stops = np.searchsorted(key, base), np.searchsorted(key, base + (1 << (2 * CELL_BITS)))
+        else:
+            x1, y1, x2, y2 = region
+            cx1, cy1 = max(0, int((x1 - self.margin) // self.cell)), max(0, int((y1 - self.margin) // self.cell))
+            cx2, cy2 = int((x2 + self.margin) // self.cell), int((y2 + self.margin) // self.cell)
+            rows = (base[:, None] | (np.arange(cy1, cy2 + 1, dtype=np.int64) << CELL_BITS)[None, :]).ravel()
+            starts, stops = np.searchsorted(key, rows | cx1), np.searchsorted(key, rows | (cx2 + 1))
+
+        lengths = stops - starts
+        offsets = np.cumsum(lengths) - lengths
+        return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+
+class DetectionStore:
+    # Хранилище детекций по множеству снимков: каждая запись (flush) - новый
+    # сегмент в каталоге, старые сегменты не переписываются. Повторная запись
+    # того же изображения и модели заменяет прежнюю при чтении. Изображение
+    # определяется абсолютным путем, если он известен: одноименные файлы из
+    # разных каталогов - разные снимки.
+    def __init__(self, directory='detections', cell=256, flush_every=256):
+        self.directory = directory
+        self.cell = cell
+        self.flush_every = flush_every
+        self._pending = []
+        self._segments = []
+        self._latest = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, image_name, model_name, detections, params=None, path=None):
+        geo = [getattr(params, field, np.nan) if params is not None else np.nan for field in GEO_FIELDS]
+        image = os.path.abspath(path) if path else image_name
+        with self._lock:
+            self._pending.append((image, model_name, np.asarray(detections, dtype=np.float32), geo))
+            flush = len(self._pending) >= self.flush_every
+        if flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return None
+
+        images, models, entries = [], [], []
+        image_index, model_index = {}, {}
+        params = []
+        parts = []
+        # снимок, обработанный повторно до записи, берется по последнему результату
+        latest = {(image_name, model_name): item for image_name, model_name, *item in pending}
+        for (image_name, model_name), (detections, geo) in latest.items():
+            if image_name not in image_index:
+                image_index[image_name] = len(images)
+                images.append(image_name)
+                params.append(geo)
+            if model_name not in model_index:
+                model_index[model_name] = len(models)
+                models.append(model_name)
+            parts.append((image_index[image_name], model_index[model_name], detections.reshape(-1, 6)))
+            entries.append([image_index[image_name], model_index[model_name]])
+
+        data = np.concatenate([dets for _, _, dets in parts]) if parts else np.empty((0, 6), np.float32)
+        counts = [len(dets) for _, _, dets in parts]
+        image = np.repeat([i for i, _, _ in parts], counts).astype(np.uint32)
+        model = np.repeat([m for _, m, _ in parts], counts).astype(np.uint8)
+
+        centers = (data[:, :2] + data[:, 2:4]) / 2
+        cells = np.clip(centers // self.cell, 0, (1 << CELL_BITS) - 1).astype(np.int64)
+        key = (image.astype(np.int64) << (2 * CELL_BITS)) | (cells[:, 1] << CELL_BITS) | cells[:, 0]
+        order = np.argsort(key, kind='stable')
+        # бокс хранится в ячейке своего центра, поэтому запрос расширяется на половину наибольшего бокса
+        sizes = data[:, 2:4] - data[:, :2]
+        margin = float(sizes.max()) / 2 if len(data) else 0.0
+
+        columns = {
+            'boxes': data[order, :4],
+            'conf': data[order, 4],
+            'cls': data[order, 5],
+            'model': model[order],
+            'image': image[order],
+            'key': key[order],
+        }
+
+        name = f"{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{len(os.listdir(self.directory)):06d}"
+        tmp_path = os.path.join(self.directory, f".{name}.tmp")
+        os.makedirs(tmp_path)
+        for column, dtype in COLUMNS.items():
+            np.save(os.path.join(tmp_path, f"{column}.npy"), columns[column].astype(dtype))
+        np.save(os.path.join(tmp_path, 'params.npy'), np.array(params, dtype=np.float64).reshape(-1, len(GEO_FIELDS)))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'images': images, 'models': models, 'entries': entries, 'cell': self.cell, 'margin': margin,
+                       'geo_fields': GEO_FIELDS}, f, ensure_ascii=False)
+        path = os.path.join(self.directory, name)
+        os.replace(tmp_path, path)
+        return path
+
+    def segments(self):
+        with self._lock:
+            loaded = {segment.path for segment in self._segments}
+            for name in sorted(os.listdir(self.directory)):
+                path = os.path.join(self.directory, name)
+                if name.startswith('.') or path in loaded or not os.path.isdir(path):
+                    continue
+                segment = DetectionSegment(path)
+                index = len(self._segments)
+                self._segments.append(segment)
+                # запись без детекций тоже заменяет прежний результат
+                for image_id, model_id in segment.entries:
+                    self._latest[(segment.images[image_id], segment.models[model_id])] = index
+            return list(self._segments)
+
+    def _current(self, index, segment):
+        # [снимок, модель] -> запись этого сегмента не заменена более поздней
+        current = np.zeros((len(segment.images), max(len(segment.models), 1)), dtype=bool)
+        for image_id, model_id in segment.entries:
+            current[image_id, model_id] = self._latest[(segment.images[image_id], segment.models[model_id])] == index
+        return current
+
+    def _select(self, segment, images):
+        # снимки сегмента по именам файлов или путям
+        return [i for i, image in enumerate(segment.images)
+                if image in images or os.path.basename(image) in images]
+
+    def images(self, geo_region=None):
+        # снимки (пути или имена) и их параметры; geo_region = (lat_min, lon_min, lat_max, lon_max)
+        result = {}
+        for segment in self.segments():
+            for name, geo in zip(segment.images, segment.params.tolist()):
+                lat, lon = geo[0], geo[1]
+                if geo_region is not None and not (geo_region[0] <= lat <= geo_region[2] and
+                                                   geo_region[1] <= lon <= geo_region[3]):
+                    continue
+                result[name] = dict(zip(GEO_FIELDS, geo))
+        return result
+
+    def query(self, images=None, region=None, classes=None, models=None, min_conf=0.0, geo_region=None):
+        # region - (x1, y1, x2, y2) в пикселях снимка; без images - по всем снимкам.
+        # geo_region - (lat_min, lon_min, lat_max, lon_max) по географическим координатам
+        # центров боксов; у снимков без параметров РЛИ lat/lon - NaN
+        images = set(images) if images is not None else None
+
+        parts = []
+        for index, segment in enumerate(self.segments()):
+            if images is None and region is None:
+                rows = slice(None)
+            else:
+                if images is None:
+                    image_ids = np.arange(len(segment.images))
+                else:
+                    image_ids = self._select(segment, images)
+                rows = segment.rows(image_ids, region)
+                if not len(rows):
+                    continue
+            columns = {name: np.asarray(column[rows]) for name, column in segment.columns.items()}
+
+            keep = columns['conf'] >= min_conf
+            if region is not None:
+                boxes = columns['boxes']
+                keep &= ((boxes[:, 2] >= region[0]) & (boxes[:, 0] <= region[2]) &
+                         (boxes[:, 3] >= region[1]) & (boxes[:, 1] <= region[3]))
+            if classes is not None:
+                keep &= np.isin(columns['cls'], list(classes))
+            model_names = np.array(segment.models, dtype=object)
+            if models is not None:
+                keep &= np.isin(model_names[columns['model']], list(models))
+
+            keep &= self._current(index, segment)[columns['image'], columns['model']]
+            if not keep.any():
+                continue
+
+            boxes = columns['boxes'][keep]
+            image_ids = columns['image'][keep]
+            # пересчет в координаты - одним вызовом на весь сегмент, параметры снимка по строкам
+            geo = segment.params[image_ids].T
+            lat, lon = pixel_to_geo((boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2, *geo)
+            inside = slice(None)
+            if geo_region is not None:
+                inside = ((lat >= geo_region[0]) & (lat <= geo_region[2]) &
+                          (lon >= geo_region[1]) & (lon <= geo_region[3]))
+                if not inside.any():
+                    continue
+
+            image_names = np.array(segment.images, dtype=object)[image_ids]
+            parts.append((image_names[inside], model_names[columns['model'][keep]][inside], boxes[inside],
+                          columns['conf'][keep][inside].astype(np.float32), columns['cls'][keep][inside],
+                          lat[inside], lon[inside]))
+
+        if not parts:
+            return {'image': np.empty(0, dtype=object), 'model': np.empty(0, dtype=object),
+                    'boxes': np.empty((0, 4), np.float32), 'conf': np.empty(0, np.float32),
+                    'cls': np.empty(0, np.uint16), 'lat': np.empty(0), 'lon': np.empty(0)}
+        return {name: np.concatenate([part[i] for part in parts])
+                for i, name in enumerate(('image', 'model', 'boxes', 'conf', 'cls', 'lat', 'lon'))}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Запрос к хранилищу детекций")
+    parser.add_argument('--store', default='detections')
+    parser.add_argument('--image', nargs='+', help="имена снимков")
+    parser.add_argument('--region', type=float, nargs=4, metavar=('X1', 'Y1', 'X2', 'Y2'))
+    parser.add_argument('--geo-region', type=float, nargs=4, metavar=('LAT1', 'LON1', 'LAT2', 'LON2'))
+    parser.add_argument('--cls', type=int, nargs='+')
+    parser.add_argument('--model', nargs='+')
+    parser.add_argument('--conf', type=float, default=0.0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    found = DetectionStore(args.store).query(args.image, args.region, args.cls, args.model, args.conf, args.geo_region)
+    elapsed = time.perf_counter() - start
+    for image, model, box, conf, cls, lat, lon in zip(found['image'], found['model'], found['boxes'].tolist(),
+                                                      found['conf'].tolist(), found['cls'].tolist(),
+                                                      found['lat'].tolist(), found['lon'].tolist()):
+        print(f"{image}\t{model}\t{int(cls)}\t{conf:.3f}\t" + "\t".join(f"{v:.1f}" for v in box) +
+              f"\t{lat:.6f}\t{lon:.6f}")
+    print(f"Найдено {len(found['conf'])} детекций за {elapsed * 1000:.1f} ms")
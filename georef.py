@@ -0,0 +1,37 @@
+import numpy as np
+
+GEO_FIELDS = ('latitude', 'longtitude', 'way_angle', 'dx', 'dy')
+
+EARTH_RADIUS = 6371008.8
+
+
+def params_array(params):
+    return np.array([getattr(params, field) for field in GEO_FIELDS], dtype=np.float64)
+
+
+def pixel_to_geo(x, y, latitude, longtitude, way_angle, dx, dy):
+    # Локальная касательная плоскость в точке привязки кадра: (latitude, longtitude) -
+    # пиксель (0, 0), строки идут вдоль путевого угла way_angle (градусы от севера
+    # по часовой стрелке), столбцы - поперек, вправо от направления движения;
+    # dx, dy - метров на пиксель. Все аргументы - массивы или числа, с broadcasting.
+    along = np.asarray(y, dtype=np.float64) * dy
+    across = np.asarray(x, dtype=np.float64) * dx
+    heading = np.radians(way_angle)
+    north = along * np.cos(heading) - across * np.sin(heading)
+    east = along * np.sin(heading) + across * np.cos(heading)
+
+    lat = latitude + np.degrees(north / EARTH_RADIUS)
+    lon = longtitude + np.degrees(east / (EARTH_RADIUS * np.cos(np.radians(latitude))))
+    return lat, lon
+
+
+def detections_to_geo(detections, params):
+    # [широта, долгота, размер вдоль столбцов (м), размер вдоль строк (м)] центров всех боксов кадра
+    latitude, longtitude, way_angle, dx, dy = params_array(params)
+    detections = np.asarray(detections, dtype=np.float64).reshape(-1, 6)
+    cx = (detections[:, 0] + detections[:, 2]) / 2
+    cy = (detections[:, 1] + detections[:, 3]) / 2
+    lat, lon = pixel_to_geo(cx, cy, latitude, longtitude, way_angle, dx, dy)
+    width = (detections[:, 2] - detections[:, 0]) * dx
+    height = (detections[:, 3] - detections[:, 1]) * dy
+    return np.stack([lat, lon, width, height], axis=1)
@@ -0,0 +1,278 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from types import SimpleNamespace
+import numpy as np
+from pathlib import Path
+from PIL import Image
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+class FrameImage:
+    # Кадр РЛИ поверх массива self.data: 16-битные и float данные
+    # нормируются в uint8 по диапазону всего кадра при чтении окна.
+    # params - параметры кадра из заголовка РЛИ (координаты привязки и шаг).
+    params = None
+
+    def __getitem__(self, key):
+        window = self.data[key]
+        if self.data.dtype == np.uint8:
+            return np.asarray(window)
+
+        min_val, max_val = self.value_range()
+        if max_val <= min_val:
+            return np.zeros(window.shape, dtype=np.uint8)
+        return ((window - min_val) * (255.0 / (max_val - min_val))).astype(np.uint8)
+
+    def value_range(self, chunk_rows=1024):
+        if self._value_range is None:
+            min_val, max_val = None, None
+            for y in range(0, self.shape[0], chunk_rows):
+                chunk = self.data[y:y + chunk_rows]
+                chunk_min, chunk_max = chunk.min(), chunk.max()
+                min_val = chunk_min if min_val is None else min(min_val, chunk_min)
+                max_val = chunk_max if max_val is None else max(max_val, chunk_max)
+            self._value_range = (min_val, max_val) if min_val is not None else (0, 0)
+        return self._value_range
+
+
+def _frame_dtype(dtype):
+    dtype = np.dtype(dtype)
+    if dtype == np.int8:
+        # байты CHAR отображаются как есть, как при Image.fromarray(..., mode='L')
+        return np.dtype(np.uint8)
+    return dtype
+
+
+class RawImage(FrameImage):
+    # Кадр в RAW-файле: строки читаются с диска по мере обращения к окнам
+    def __init__(self, path, width, dtype, height=None):
+        dtype = _frame_dtype(dtype)
+        rows = Path(path).stat().st_size // (width * dtype.itemsize)
+        if height is not None:
+            rows = min(rows, height)
+
+        self.path = str(path)
+        self.data = np.memmap(path, dtype=dtype, mode='r', shape=(rows, width))
+        self.shape = (rows, width)
+        self._value_range = None
+
+
+class StreamingImage(FrameImage):
+    # Кадр, который еще принимается: строки становятся доступны по мере записи.
+    # Без path кадр хранится в памяти, иначе - в RAW-файле через memmap.
+    def __init__(self, width, total_size, dtype, path=None):
+        dtype = _frame_dtype(dtype)
+        self.row_bytes = width * dtype.itemsize
+        rows = total_size // self.row_bytes
+
+        if path is None:
+            self.buffer = np.empty(total_size, dtype=np.uint8)
+        else:
+            self.buffer = np.memmap(path, dtype=np.uint8, mode='w+', shape=(total_size,))
+        self.path = path
+        self.data = self.buffer[:rows * self.row_bytes].view(dtype).reshape(rows, width)
+        self.shape = (rows, width)
+        self.total_size = total_size
+        self.bytes_received = 0
+        self.rows_ready = 0
+        self._failed = False
+        self._condition = threading.Condition()
+        self._value_range = None
+
+    def write(self, chunk):
+        start = self.bytes_received
+        self.buffer[start:start + len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+        self.advance(len(chunk))
+
+    def advance(self, num_bytes):
+        with self._condition:
+            self.bytes_received += num_bytes
+            self.rows_ready = min(self.bytes_received // self.row_bytes, self.shape[0])
+            self._condition.notify_all()
+
+    def abort(self):
+        with self._condition:
+            self._failed = True
+            self._condition.notify_all()
+
+    def wait_rows(self, rows):
+        if self.data.dtype != np.uint8:
+            # для нормировки нужен диапазон всего кадра
+            rows = self.shape[0]
+        with self._condition:
+            self._condition.wait_for(lambda: self.rows_ready >= rows or self._failed)
+            if self.rows_ready < rows:
+                raise ConnectionError("Прием кадра прерван")
+
+    def __getitem__(self, key):
+        if self.data.dtype != np.uint8:
+            self.wait_rows(self.shape[0])
+        return super().__getitem__(key)
+
+
+class TiffImage:
+    # Сжатый или тайловый TIFF, который нельзя отобразить в память: при чтении окна
+    # декодируются только пересекающие его сегменты страницы (полосы или тайлы).
+    # Недавние сегменты кэшируются - соседние окна с перекрытием читают одни и те же.
+    def __init__(self, path, cache_segments=64):
+        self.path = str(path)
+        self._tif = tifffile.TiffFile(path)
+        self.page = self._tif.pages[0]
+        self.shape = self.page.shape
+        self.dtype = self.page.dtype
+        self.segment_shape = self.page.chunks[:2]
+        self.grid = self.page.chunked[:2]
+        self.cache_segments = cache_segments
+        self._segments = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def supported(page):
+        # LZW, JPEG и др. без пакета imagecodecs tifffile не декодирует - такие файлы читает PIL
+        return (page.dtype == np.uint8 and page.planarconfig == 1 and
+                (len(page.shape) == 2 or (len(page.shape) == 3 and page.shape[2] == 3)) and
+                page.compression in tifffile.TIFF.DECOMPRESSORS and
+                page.predictor in tifffile.TIFF.UNPREDICTORS)
+
+    def _segment(self, index):
+        with self._lock:
+            segment = self._segments.get(index)
+            if segment is not None:
+                self._segments.move_to_end(index)
+                return segment
+            handle = self._tif.filehandle
+            handle.seek(self.page.dataoffsets[index])
+            data = handle.read(self.page.databytecounts[index])
+
+        segment, _, _ = self.page.decode(data, index, jpegtables=self.page.jpegtables)
+        segment = segment[0] if len(self.shape) == 3 else segment[0, ..., 0]
+        with self._lock:
+            self._segments[index] = segment
+            while len(self._segments) > self.cache_segments:
+                self._segments.popitem(last=False)
+        return segment
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (2 - len(key))
+        rows = range(*key[0].indices(self.shape[0]))
+        columns = range(*key[1].indices(self.shape[1]))
+        result = np.empty((len(rows), len(columns)) + self.shape[2:], dtype=self.dtype)
+        if not len(rows) or not len(columns):
+            return result
+
+        seg_h, seg_w = self.segment_shape
+        x1, x2 = columns[0], columns[-1] + 1
+        sx1, sx2 = x1 // seg_w, (x2 - 1) // seg_w + 1
+        ys = np.asarray(rows)
+        xs = np.asarray(columns) - sx1 * seg_w
+        # по полосам сегментов: в памяти одна полоса окна, а не весь кадр
+        for sy in range(ys[0] // seg_h, ys[-1] // seg_h + 1):
+            selected = (ys >= sy * seg_h) & (ys < (sy + 1) * seg_h)
+            if not selected.any():
+                continue
+            band = np.concatenate([self._segment(sy * self.grid[1] + sx) for sx in range(sx1, sx2)], axis=1)
+            result[selected] = band[ys[selected] - sy * seg_h][:, xs]
+        return result
+
+
+_pixel_limit_lock = threading.Lock()
+_pixel_limit = [0, None]
+
+
+@contextmanager
+def unlimited_pixels():
+    # полосы РЛИ бывают больше предела PIL против "декомпрессионных бомб"
+    # (DecompressionBombError - не OSError); предел снимается на время вызова,
+    # вложенные и параллельные вызовы считаются, и предел возвращает последний
+    with _pixel_limit_lock:
+        if _pixel_limit[0] == 0:
+            _pixel_limit[1], Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None
+        _pixel_limit[0] += 1
+    try:
+        yield
+    finally:
+        with _pixel_limit_lock:
+            _pixel_limit[0] -= 1
+            if _pixel_limit[0] == 0:
+                Image.MAX_IMAGE_PIXELS = _pixel_limit[1]
+
+
+def image_size(image_path):
+    # (ширина, высота) по заголовку файла, без декодирования
+    if tifffile is not None and os.path.splitext(image_path)[1].lower() in ('.tif', '.tiff'):
+        try:
+            with tifffile.TiffFile(image_path) as tif:
+                page = tif.pages[0]
+                return page.imagewidth, page.imagelength
+        except (OSError, ValueError):
+            pass
+    with unlimited_pixels():
+        with Image.open(image_path) as img:
+            return img.size
+
+
+def open_image(image_path):
+    # Несжатые TIFF отображаются в память без декодирования целиком, сжатые и
+    # тайловые читаются по сегментам; остальные форматы декодируются, серые
+    # остаются одноканальными.
+    if tifffile is not None and os.path.splitext(image_path)[1].lower() in ('.tif', '.tiff'):
+        try:
+            data = tifffile.memmap(image_path, mode='r')
+            if data.dtype == np.uint8 and (data.ndim == 2 or (data.ndim == 3 and data.shape[2] == 3)):
+                return data
+        except ValueError:
+            try:
+                image = TiffImage(image_path)
+                if TiffImage.supported(image.page):
+                    return image
+                image._tif.close()
+            except (OSError, ValueError):
+                pass
+
+    img = Image.open(image_path)
+    if img.mode not in ('L', 'RGB'):
+        img = img.convert('RGB')
+    return np.asarray(img)
+
+
+def read_params(image_path):
+    # параметры РЛИ, записанные в описание TIFF при сохранении кадра;
+    # читается только заголовок, без проверки PIL на число пикселей
+    if os.path.splitext(image_path)[1].lower() not in ('.tif', '.tiff'):
+        return None
+    try:
+        if tifffile is not None:
+            with tifffile.TiffFile(image_path) as tif:
+                description = tif.pages[0].description
+        else:
+            with unlimited_pixels(), Image.open(image_path) as img:
+                description = img.tag_v2.get(270)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    if not description:
+        return None
+    try:
+        return SimpleNamespace(**json.loads(description)['rli_params'])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def image_params(image):
+    if isinstance(image, (str, os.PathLike)):
+        return read_params(image)
+    return getattr(image, 'params', None)
+
+
+def to_rgb(window):
+    if window.ndim == 2:
+        return np.repeat(window[..., None], 3, axis=2)
+    return np.array(window)
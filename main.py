@@ -4,9 +4,10 @@ from PyQt5.QtWidgets import QApplication
 from view import MainWindow
 from controller import AppController
 
-app = QApplication(sys.argv)
-app.setWindowIcon(QIcon("Vega_radio.ico"))
-window = MainWindow()
-controller = AppController(window)
-window.show()
-sys.exit(app.exec_())
\ No newline at end of file
+if __name__ == '__main__':
+    app = QApplication(sys.argv)
+    app.setWindowIcon(QIcon("Vega_radio.ico"))
+    window = MainWindow()
+    controller = AppController(window)
+    window.show()
+    sys.exit(app.exec_())
\ No newline at end of file
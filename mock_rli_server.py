@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+import struct
+import numpy as np
+from model import ModeRLI, RLI_DTYPES, MODE_FORMAT, PARAMS_FORMAT
+
+
+class MockRLIServer:
+    # Локальный сервер РЛИ для проверки клиента и замера пропускной способности:
+    # на каждый запрос Mode отдает синтетический кадр запрошенного размера.
+    def __init__(self, host='127.0.0.1', port=9977, latitude=55.75, longtitude=37.62, way_angle=0.0,
+                 dy=1.0, dx=1.0, seed=0):
+        self.host = host
+        self.port = port
+        self.latitude = latitude
+        self.longtitude = longtitude
+        self.way_angle = way_angle
+        self.dy = dy
+        self.dx = dx
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self._rng = np.random.default_rng(seed)
+        self._frames = {}
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        print(f"Mock RLI server at {self.host}:{self.port}")
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def frame(self, mode, size_x, size_y):
+        key = (mode, size_x, size_y)
+        if key not in self._frames:
+            # шум с несколькими яркими прямоугольниками-целями
+            dtype = np.dtype(RLI_DTYPES[mode])
+            image = self._rng.integers(0, 64, (size_y, size_x)).astype(dtype)
+            for _ in range(max(1, size_x * size_y // 200000)):
+                y = self._rng.integers(0, max(1, size_y - 16))
+                x = self._rng.integers(0, max(1, size_x - 32))
+                image[y:y + 16, x:x + 32] = 120
+            self._frames[key] = image.tobytes()
+        return self._frames[key]
+
+    async def _handle(self, reader, writer):
+        num_cadr = 0
+        try:
+            while True:
+                request = await reader.readexactly(struct.calcsize(MODE_FORMAT))
+                mode_char, size_x, size_y = struct.unpack(MODE_FORMAT, request)
+                mode = ModeRLI(mode_char.decode('ascii'))
+
+                payload = self.frame(mode, size_x, size_y)
+                header = struct.pack('=Q', len(payload)) + struct.pack(
+                    PARAMS_FORMAT, mode_char, size_x, size_y, num_cadr,
+                    self.latitude, self.longtitude, self.way_angle, self.dy, self.dx)
+                writer.write(header)
+                writer.write(payload)
+                await writer.drain()
+
+                num_cadr = (num_cadr + 1) % 128
+                self.frames_sent += 1
+                self.bytes_sent += len(payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Локальный сервер РЛИ с синтетическими кадрами")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9977)
+    args = parser.parse_args()
+    asyncio.run(MockRLIServer(args.host, args.port).serve_forever())
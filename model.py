@@ -1,4 +1,5 @@
-import socket, struct, os
+import socket, struct, threading, time, queue, json
+from concurrent.futures import ThreadPoolExecutor, wait
 from PyQt5.QtCore import pyqtSignal, QObject
 from enum import Enum
 from dataclasses import dataclass
@@ -7,6 +8,10 @@ from datetime import datetime
 from PyQt5.QtCore import QThread, pyqtSignal
 from PIL import Image
 import numpy as np
+from image_source import RawImage, StreamingImage, open_image
+from georef import GEO_FIELDS
+from batch_executor import BatchDetector
+from profiling import ProcessingStats
 
 class ModeRLI(Enum):
     CHAR = '0'
@@ -14,6 +19,13 @@ class ModeRLI(Enum):
     USHORT = '2'
     FLOAT = '4'
 
+RLI_DTYPES = {
+    ModeRLI.CHAR: np.int8,
+    ModeRLI.UCHAR: np.uint8,
+    ModeRLI.USHORT: np.uint16,
+    ModeRLI.FLOAT: np.float32
+}
+
 @dataclass
 class Mode:
     mode_rli: ModeRLI
@@ -32,19 +44,65 @@ class Params:
     dy: float
     dx: float
 
+MODE_FORMAT = '=chh'
+PARAMS_FORMAT = '=c2hb3d2f'
+
+def pack_mode(mode: Mode):
+    return struct.pack(
+        MODE_FORMAT,
+        mode.mode_rli.value.encode('ascii'),
+        mode.size_x,
+        mode.size_y
+    )
+
+def unpack_params(params_data):
+    fields = struct.unpack(PARAMS_FORMAT, params_data)
+    
+    return Params(
+        mode_rli=ModeRLI(fields[0].decode('ascii')),
+        size_x=fields[1],
+        size_y=fields[2],
+        num_cadr=fields[3],
+        latitude=fields[4],
+        longtitude=fields[5],
+        way_angle=fields[6],
+        dy=fields[7],
+        dx=fields[8]
+    )
+
+
+def frame_geo(model, file_name, conf):
+    # координаты всех детекций кадра при текущем пороге; None без параметров РЛИ
+    if file_name not in model.params:
+        return None
+    return model.georeference(file_name, model.rethreshold(file_name, conf))
+
 class RLIClient(QObject):
     receive_data_percent = pyqtSignal(int, str)
+    file_archived = pyqtSignal(str)
     
-    def __init__(self, host='127.0.0.1', port=9977):
+    def __init__(self, host='127.0.0.1', port=9977, recv_buffer_size=4 * 1024 * 1024,
+                 chunk_size=1024 * 1024, progress_step=1, progress_interval=0.1):
         super().__init__()
+        self.recv_buffer_size = recv_buffer_size
+        self.chunk_size = chunk_size
+        self.progress_step = progress_step
+        self.progress_interval = progress_interval
         self.set_connect(host, port)
         self.mode = ModeRLI.CHAR
+        # архивирование TIFF идет в фоне, вне пути прием -> детекция
+        self._archive_executor = ThreadPoolExecutor(max_workers=1)
+        self._archive_futures = []
+        self._archive_lock = threading.Lock()
+        self._frame_number = 0
         
         
     def set_connect(self, host, port):
         self.host = host
         self.port = port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.recv_buffer_size:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer_size)
         self.connected = False
         
     def connect(self):
@@ -57,11 +115,32 @@ class RLIClient(QObject):
             print(f"Connection error: {e}")
             return False
     
+    def connect_with_retry(self, stop_event, initial_backoff=1.0, max_backoff=30.0):
+        # переподключение с экспоненциальной задержкой, пока не выставлен stop_event
+        backoff = initial_backoff
+        while not stop_event.is_set():
+            self.set_connect(self.host, self.port)
+            if self.connect():
+                return True
+            self.socket.close()
+            print(f"Retrying in {backoff:.0f} s")
+            stop_event.wait(backoff)
+            backoff = min(backoff * 2, max_backoff)
+        return False
+    
     def disconnect(self):
         if self.connected:
             self.socket.close()
             self.connected = False
             print("Disconnected from server")
+    
+    def interrupt(self):
+        # прерывает блокирующий прием из другого потока
+        if self.connected:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
             
     def set_mode(self, mode):
         self.mode = mode
@@ -75,13 +154,7 @@ class RLIClient(QObject):
             return False
         
         try:
-            data = struct.pack(
-                '=chh', 
-                mode.mode_rli.value.encode('ascii'),
-                mode.size_x,
-                mode.size_y
-            )
-            self.socket.sendall(data)
+            self.socket.sendall(pack_mode(mode))
             return True
         except struct.error as e:
             print(f"Error packing mode structure: {e}")
@@ -96,42 +169,28 @@ class RLIClient(QObject):
             return None
         
         try:
-            total_size_data = self._receive_exact(8)
-            if not total_size_data:
+            header = self._receive_header()
+            if not header:
                 return None
-                
-            total_size = struct.unpack('=Q', total_size_data)[0]  
-            print(f"Total size to receive: {total_size} bytes")
             
-            params_data = self._receive_exact(38)
-            if not params_data:
-                return None
-            
-            params = self._unpack_params(params_data)
-            if not params:
-                return None
-                
-            print(f"Received params: {params}")
+            total_size, params = header
             
             bytes_received = 0
             output_path = Path(output_file)
+            buffer = bytearray(min(self.chunk_size, total_size) or 1)
+            view = memoryview(buffer)
+            self._reset_progress()
             
             with output_path.open('wb') as f:
                 while bytes_received < total_size:
-                    chunk_size = min(65536, total_size - bytes_received)
-                    chunk = self._receive_exact(chunk_size)
-                    if not chunk:
+                    chunk_size = self.socket.recv_into(view, min(len(buffer), total_size - bytes_received))
+                    if not chunk_size:
                         print("Connection terminated prematurely")
                         return None
                         
-                    f.write(chunk)
-                    bytes_received += len(chunk)
-                    
-                    if progress_callback:
-                        progress_callback(bytes_received, total_size)
-                    
-                    self.receive_data_percent.emit(int(bytes_received/total_size * 100), 'Загрузка изображения')
-                    print(f"Received {bytes_received}/{total_size} bytes ({bytes_received/total_size:.1%})")
+                    f.write(view[:chunk_size])
+                    bytes_received += chunk_size
+                    self._report_progress(bytes_received, total_size, progress_callback)
             
             print(f"Successfully received {bytes_received} bytes and saved to {output_path}")
             return params, str(output_path)
@@ -140,89 +199,173 @@ class RLIClient(QObject):
             print(f"Error receiving data: {e}")
             return None
     
-    def raw_to_tiff(self, raw_file, tiff_file, width, mode):
+    def receive_stream(self, on_frame=None, output_file=None, stats=None):
+        if not self.connected:
+            print("Not connected to server")
+            return None
+        
+        frame = None
         try:
-            dtype_map = {
-                ModeRLI.CHAR: np.int8,
-                ModeRLI.UCHAR: np.uint8,
-                ModeRLI.USHORT: np.uint16,
-                ModeRLI.FLOAT: np.float32
-            }
+            stats = stats if stats is not None else ProcessingStats()
+            with stats.stage('header'):
+                header = self._receive_header()
+            if not header:
+                return None
             
-            dtype = dtype_map.get(mode)
+            total_size, params = header
+            dtype = RLI_DTYPES.get(params.mode_rli)
             if dtype is None:
-                print(f"Unsupported mode: {mode}")
-                return False
-            with open(raw_file, 'rb') as f:
-                raw_data = np.fromfile(f, dtype=dtype)
-            available_pixels = len(raw_data)
-            height = available_pixels // width
-            expected_size = width * height * np.dtype(dtype).itemsize
-            actual_size = Path(raw_file).stat().st_size
+                print(f"Unsupported mode: {params.mode_rli}")
+                return None
             
-            if actual_size < expected_size:
-                print(f"Warning: RAW file is smaller than expected ({actual_size} < {expected_size})")
-                height = actual_size // (width * np.dtype(dtype).itemsize)
-                print(f"Adjusted height to {height}")
+            frame = StreamingImage(params.size_x, total_size, dtype, output_file)
+            frame.params = params
+            if on_frame:
+                on_frame(params, frame)
             
-            expected_pixels = width * height
-            if available_pixels < expected_pixels:
-                print(f"Warning: Not enough pixels ({available_pixels} < {expected_pixels})")
-                raw_data = np.pad(raw_data, (0, expected_pixels - available_pixels), mode='constant')
-            elif available_pixels > expected_pixels:
-                raw_data = raw_data[:expected_pixels]
+            # прием напрямую в буфер кадра, без промежуточных bytes
+            view = memoryview(frame.buffer)
+            self._reset_progress()
+            with stats.stage('receive', bytes=total_size):
+                while frame.bytes_received < total_size:
+                    start = frame.bytes_received
+                    chunk_size = self.socket.recv_into(view[start:start + self.chunk_size])
+                    if not chunk_size:
+                        print("Connection terminated prematurely")
+                        frame.abort()
+                        return None
+                    
+                    frame.advance(chunk_size)
+                    stats.count('chunks')
+                    self._report_progress(frame.bytes_received, total_size)
+            stats.count('bytes', total_size)
             
-            image_data = raw_data.reshape((height, width))
+            print(f"Successfully received {frame.bytes_received} bytes")
+            return params, frame
             
-            if mode in (ModeRLI.CHAR, ModeRLI.UCHAR):
-                pass
-            else:
-                min_val = np.min(image_data)
-                max_val = np.max(image_data)
-                if max_val > min_val:
-                    image_data = ((image_data - min_val) * (255.0 / (max_val - min_val))).astype(np.uint8)
-                else:
-                    image_data = np.zeros_like(image_data, dtype=np.uint8)
+        except (socket.error, struct.error, IOError) as e:
+            print(f"Error receiving data: {e}")
+            if frame is not None:
+                frame.abort()
+            return None
+    
+    def _receive_header(self):
+        total_size_data = self._receive_exact(8)
+        if not total_size_data:
+            return None
             
-            current_time = datetime.now()
-
-            formatted_time = current_time.strftime("%Y-%m-%d-%H-%M-%S")
+        total_size = struct.unpack('=Q', total_size_data)[0]  
+        print(f"Total size to receive: {total_size} bytes")
+        
+        params_data = self._receive_exact(struct.calcsize(PARAMS_FORMAT))
+        if not params_data:
+            return None
+        
+        params = self._unpack_params(params_data)
+        if not params:
+            return None
             
-            img = Image.fromarray(image_data, mode='L')  
-            img = img.convert('RGB')
-            img.save(f'client_image/image_{formatted_time}.tiff', format='TIFF')
+        print(f"Received params: {params}")
+        return total_size, params
+    
+    def open_raw(self, raw_file, width, mode, params=None):
+        dtype = RLI_DTYPES.get(mode)
+        if dtype is None:
+            print(f"Unsupported mode: {mode}")
+            return None
+        image = RawImage(raw_file, width, dtype)
+        image.params = params
+        return image
+
+    def raw_to_tiff(self, raw_file, tiff_file, width, mode, params=None):
+        try:
+            raw_image = self.open_raw(raw_file, width, mode, params)
+            if raw_image is None:
+                return False
             
+            file_name = self.save_tiff(raw_image)
             print(f"Successfully converted {raw_file} to {tiff_file}")
-            return f'image_{formatted_time}.tiff'
+            return file_name
             
         except Exception as e:
             print(f"Error converting RAW to TIFF: {e}")
             return False
     
+    def save_tiff(self, image, file_name=None):
+        if file_name is None:
+            file_name = self.new_image_name()
+        img = Image.fromarray(image[:, :], mode='L')
+        tiffinfo = {}
+        params = getattr(image, 'params', None)
+        if params is not None:
+            # параметры привязки остаются с кадром и после повторного открытия файла
+            geo = {field: getattr(params, field) for field in GEO_FIELDS}
+            tiffinfo[270] = json.dumps({'rli_params': dict(geo, num_cadr=params.num_cadr)})
+        img.save(f'client_image/{file_name}', format='TIFF', tiffinfo=tiffinfo)
+        return file_name
+    
+    def archive_tiff(self, image, file_name):
+        # вызывается из потоков приема; о записанном файле сообщает сигнал file_archived
+        with self._archive_lock:
+            future = self._archive_executor.submit(self._archive_job, image, file_name)
+            self._archive_futures = [f for f in self._archive_futures if not f.done()] + [future]
+        return future
+
+    def _archive_job(self, image, file_name):
+        try:
+            self.save_tiff(image, file_name)
+        except Exception as e:
+            print(f"Error saving TIFF: {e}")
+            raise
+        self.file_archived.emit(file_name)
+        return file_name
+    
+    def wait_archived(self):
+        with self._archive_lock:
+            futures = list(self._archive_futures)
+        wait(futures)
+        with self._archive_lock:
+            self._archive_futures = [f for f in self._archive_futures if f not in futures]
+    
+    def new_image_name(self):
+        # номер кадра в имени: в непрерывном режиме кадры приходят чаще раза в секунду
+        self._frame_number += 1
+        formatted_time = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+        return f'image_{formatted_time}_{self._frame_number}.tiff'
+    
     def _receive_exact(self, num_bytes):
-        data = b''
-        while len(data) < num_bytes:
-            chunk = self.socket.recv(num_bytes - len(data))
-            if not chunk:
+        data = bytearray(num_bytes)
+        view = memoryview(data)
+        received = 0
+        while received < num_bytes:
+            chunk_size = self.socket.recv_into(view[received:])
+            if not chunk_size:
                 return None
-            data += chunk
-        return data
+            received += chunk_size
+        return bytes(data)
+    
+    def _reset_progress(self):
+        self._last_percent = None
+        self._last_report = 0.0
+    
+    def _report_progress(self, received, total, progress_callback=None):
+        # сигнал не чаще шага в процентах и интервала по времени, плюс завершение
+        percent = int(received / total * 100)
+        now = time.monotonic()
+        if received < total and self._last_percent is not None and (
+                percent - self._last_percent < self.progress_step or
+                now - self._last_report < self.progress_interval):
+            return
+        self._last_percent = percent
+        self._last_report = now
+        
+        if progress_callback:
+            progress_callback(received, total)
+        self.receive_data_percent.emit(percent, 'Загрузка изображения')
     
     def _unpack_params(self, params_data):
         try:
-            fields = struct.unpack('=c2hb3d2f', params_data)
-            
-            return Params(
-                mode_rli=ModeRLI(fields[0].decode('ascii')),
-                size_x=fields[1],
-                size_y=fields[2],
-                num_cadr=fields[3],
-                latitude=fields[4],
-                longtitude=fields[5],
-                way_angle=fields[6],
-                dy=fields[7],
-                dx=fields[8]
-            )
+            return unpack_params(params_data)
         except (struct.error, ValueError) as e:
             print(f"Error unpacking params: {e}")
             return None
@@ -230,27 +373,32 @@ class RLIClient(QObject):
 class ImageProcessingWorker(QThread):
     progress_updated = pyqtSignal(int, str)
     file_processed = pyqtSignal(str, int)
+    geo_ready = pyqtSignal(str, object)
+    stats_ready = pyqtSignal(object)
     finished = pyqtSignal()
     error_occurred = pyqtSignal(str)
 
-    def __init__(self, model, image_files, conf):
+    def __init__(self, model, image_files, conf, pool=None):
         super().__init__()
         self.model = model
         self.image_files = image_files
         self.conf = conf
+        self.pool = pool
 
     def run(self):
         try:
             total_files = len(self.image_files)
-            for i, image_path in enumerate(self.image_files):                
-                filename = os.path.basename(image_path)
-                self.progress_updated.emit(int(100 * i / total_files), filename)
-
-                try:
-                    _, detections = self.model.process_image(image_path, self.conf)
+            detector = BatchDetector(self.model, pool=self.pool)
+            for i, filename, detections, error, stats in detector.run(self.image_files, self.conf):
+                self.progress_updated.emit(int(100 * (i + 1) / total_files), filename)
+                self.stats_ready.emit(stats)
+                if error is not None:
+                    self.error_occurred.emit(f"Ошибка обработки {filename}: {str(error)}")
+                else:
+                    geo = frame_geo(self.model, filename, self.conf)
+                    if geo is not None:
+                        self.geo_ready.emit(filename, geo)
                     self.file_processed.emit(filename, detections)
-                except Exception as e:
-                    self.error_occurred.emit(f"Ошибка обработки {filename}: {str(e)}")
 
             self.progress_updated.emit(100, "")
             self.finished.emit()
@@ -258,8 +406,35 @@ class ImageProcessingWorker(QThread):
             self.error_occurred.emit(f"Критическая ошибка: {str(e)}")
             self.finished.emit()
 
+class ExportWorker(QThread):
+    # Размеченные копии изображений по сохраненным детекциям, по запросу пользователя
+    progress_updated = pyqtSignal(int, str)
+    finished = pyqtSignal()
+    error_occurred = pyqtSignal(str)
+
+    def __init__(self, model, items, conf, directory):
+        super().__init__()
+        self.model = model
+        self.items = items
+        self.conf = conf
+        self.directory = directory
+
+    def run(self):
+        try:
+            for i, (path, file_name) in enumerate(self.items):
+                detections = self.model.rethreshold(file_name, self.conf)
+                self.model.save_result(open_image(path), detections, file_name, output_dir=self.directory)
+                self.progress_updated.emit(int(100 * (i + 1) / len(self.items)), file_name)
+            self.progress_updated.emit(100, "")
+        except Exception as e:
+            self.error_occurred.emit(f"Ошибка сохранения: {str(e)}")
+        finally:
+            self.finished.emit()
+
+
 class ImageFetchWorker(QThread):
     finished = pyqtSignal(str) 
+    frame_received = pyqtSignal(object, str)
     error = pyqtSignal(str)
 
     def __init__(self, client: RLIClient, host, port, size_x, size_y):
@@ -281,22 +456,184 @@ class ImageFetchWorker(QThread):
                 self.error.emit("Ошибка отправки параметров")
                 return
 
-            result = self.client.receive_data()
+            result = self.client.receive_stream()
             if not result:
                 self.error.emit("Ошибка получения данных")
                 return
 
-            params, raw_file = result
+            _, frame = result
+            file_name = self.client.new_image_name()
+            self.client.archive_tiff(frame, file_name)
+            self.frame_received.emit(frame, file_name)
+            self.finished.emit(file_name)
+
+        except Exception as e:
+            self.error.emit(f"Ошибка: {str(e)}")
+        finally:
+            self.client.disconnect()
+
+class StreamingDetectionWorker(QThread):
+    finished = pyqtSignal(str)
+    file_processed = pyqtSignal(str, int)
+    geo_ready = pyqtSignal(str, object)
+    stats_ready = pyqtSignal(object)
+    error = pyqtSignal(str)
 
-            tiff_file = Path(raw_file).with_suffix('.tiff')
-            file_name = self.client.raw_to_tiff(raw_file, str(tiff_file), params.size_x, params.mode_rli)
-            if not file_name:
-                self.error.emit("Ошибка конвертации")
+    def __init__(self, client: RLIClient, model, host, port, size_x, size_y, conf):
+        super().__init__()
+        self.client = client
+        self.model = model
+        self.host = host
+        self.port = port
+        self.size_x = size_x
+        self.size_y = size_y
+        self.conf = conf
+
+    def run(self):
+        detector = None
+        result = {}
+        file_name = self.client.new_image_name()
+        stats = ProcessingStats(file_name)
+
+        def detect(frame):
+            try:
+                _, result['detections'] = self.model.process_image(frame, self.conf, file_name, stats)
+            except Exception as e:
+                result['error'] = e
+
+        def start_detection(params, frame):
+            # детекция стартует сразу после заголовка и идет по мере приема строк
+            nonlocal detector
+            detector = threading.Thread(target=detect, args=(frame,), daemon=True)
+            detector.start()
+
+        try:
+            self.client.set_connect(self.host, self.port)
+            if not self.client.connect():
+                self.error.emit("Не удалось подключиться к серверу")
+                return
+
+            if not self.client.send_mode(self.size_x, self.size_y):
+                self.error.emit("Ошибка отправки параметров")
+                return
+
+            received = self.client.receive_stream(start_detection, stats=stats)
+            if not received:
+                self.error.emit("Ошибка получения данных")
                 return
 
+            _, frame = received
+            self.client.archive_tiff(frame, file_name)
+
+            detector.join()
+            if 'error' in result:
+                self.error.emit(f"Ошибка обработки {file_name}: {result['error']}")
+                return
+
+            geo = frame_geo(self.model, file_name, self.conf)
+            if geo is not None:
+                self.geo_ready.emit(file_name, geo)
+            self.file_processed.emit(file_name, result['detections'])
+            self.stats_ready.emit(stats)
             self.finished.emit(file_name)
 
         except Exception as e:
             self.error.emit(f"Ошибка: {str(e)}")
         finally:
-            self.client.disconnect()
\ No newline at end of file
+            if detector is not None:
+                detector.join()
+            self.client.disconnect()
+
+
+class RLISessionWorker(QThread):
+    file_processed = pyqtSignal(str, int)
+    geo_ready = pyqtSignal(str, object)
+    finished = pyqtSignal()
+    error = pyqtSignal(str)
+
+    def __init__(self, client: RLIClient, model, host, port, size_x, size_y, conf, queue_size=2,
+                 initial_backoff=1.0, max_backoff=30.0):
+        super().__init__()
+        self.client = client
+        self.model = model
+        self.host = host
+        self.port = port
+        self.size_x = size_x
+        self.size_y = size_y
+        self.conf = conf
+        self.queue_size = queue_size
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        self.client.interrupt()
+
+    def _retry_after(self, backoff):
+        # сервер может принять соединение и сразу его разорвать - без паузы это цикл переподключений
+        self.client.disconnect()
+        print(f"Retrying in {backoff:.0f} s")
+        self._stop_event.wait(backoff)
+        return min(backoff * 2, self.max_backoff)
+
+    def run(self):
+        # очередь ограничена: если детекция не успевает, прием ждет
+        frames = queue.Queue(maxsize=self.queue_size)
+        detector = threading.Thread(target=self._detect_loop, args=(frames,), daemon=True)
+        detector.start()
+
+        try:
+            self.client.host, self.client.port = self.host, self.port
+            requested = False
+            backoff = self.initial_backoff
+            while not self._stop_event.is_set():
+                if not self.client.connected:
+                    if not self.client.connect_with_retry(self._stop_event, self.initial_backoff, self.max_backoff):
+                        break
+                    requested = False
+
+                if not requested and not self.client.send_mode(self.size_x, self.size_y):
+                    backoff = self._retry_after(backoff)
+                    continue
+
+                received = self.client.receive_stream()
+                if not received:
+                    if not self._stop_event.is_set():
+                        backoff = self._retry_after(backoff)
+                    continue
+                # задержка сбрасывается только после полученного кадра
+                backoff = self.initial_backoff
+
+                # следующий кадр запрашивается до обработки текущего
+                requested = not self._stop_event.is_set() and self.client.send_mode(self.size_x, self.size_y)
+                if not requested:
+                    self.client.disconnect()
+
+                _, frame = received
+                file_name = self.client.new_image_name()
+                self.client.archive_tiff(frame, file_name)
+                frames.put((frame, file_name))
+
+        except Exception as e:
+            self.error.emit(f"Ошибка: {str(e)}")
+        finally:
+            frames.put(None)
+            detector.join()
+            self.client.disconnect()
+            self.finished.emit()
+
+    def _detect_loop(self, frames):
+        while True:
+            item = frames.get()
+            if item is None:
+                return
+            frame, file_name = item
+            try:
+                _, detections = self.model.process_image(frame, self.conf, file_name)
+                geo = frame_geo(self.model, file_name, self.conf)
+                if geo is not None:
+                    self.geo_ready.emit(file_name, geo)
+                self.file_processed.emit(file_name, detections)
+            except Exception as e:
+                self.error.emit(f"Ошибка обработки {file_name}: {str(e)}")
@@ -0,0 +1,112 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from image_source import open_image, to_rgb, image_params
+from tiled_processor import RecentFrames
+from georef import detections_to_geo
+from profiling import ProcessingStats
+
+
+class MultiModelProcessor:
+    # Несколько TiledYOLOProcessor над одним декодированным изображением:
+    # модели со своими размерами тайлов работают параллельно в пуле потоков,
+    # результаты сводятся в одно изображение и отчет по группам классов.
+    def __init__(self, processors, max_workers=None, max_frames=500):
+        self.processors = processors
+        self.max_workers = max_workers or len(processors)
+        self.tmp_dir = "tmp"
+        self.reports = {}
+        self.params = {}
+        self.candidates = RecentFrames(max_frames, (self.reports, self.params))
+        self.last_stats = None
+        self.save_images = True
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # для пула процессов: результаты прошлых запусков в дочерние процессы не передаются
+        state = self.__dict__.copy()
+        state.update(reports={}, candidates={}, params={}, last_stats=None)
+        return state
+
+    def process_image(self, image, conf=0.25, filename=None, stats=None):
+        stats = stats if stats is not None else ProcessingStats(filename or "")
+        params = image_params(image)
+        if isinstance(image, (str, os.PathLike)):
+            filename = filename or os.path.basename(image)
+            stats.name = filename
+            with stats.stage('decode'):
+                image = open_image(image)
+        if params is not None:
+            self.params[filename] = params
+
+        self.candidates[filename] = self.detect_candidates(image, conf, stats)
+        detections = self.rethreshold(filename, conf)
+        result_img = self.save_result(image, detections, filename, stats) if self.save_images else None
+        self.last_stats = stats
+        return result_img, self.count_detections(detections)
+
+    @property
+    def floor_conf(self):
+        return max(processor.floor_conf for processor in self.processors.values())
+
+    def detect(self, image, conf=0.25, stats=None):
+        return self.threshold(self.detect_candidates(image, conf, stats), conf)
+
+    def detect_candidates(self, image, conf=0.25, stats=None):
+        stats = stats if stats is not None else ProcessingStats()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {name: executor.submit(processor.detect_candidates, image, conf, stats)
+                       for name, processor in self.processors.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    def threshold(self, detections, conf):
+        return {name: self.processors[name].threshold(dets, conf) for name, dets in detections.items()}
+
+    def georeference(self, filename, detections):
+        params = self.params.get(filename)
+        if params is None:
+            return None
+        return {name: detections_to_geo(dets, params) for name, dets in detections.items()}
+
+    def rethreshold(self, filename, conf):
+        # отчет по моделям обновляется при каждом применении порога, а не при сохранении
+        detections = self.threshold(self.candidates[filename], conf)
+        self.reports[filename] = {name: len(dets) for name, dets in detections.items()}
+        return detections
+
+    def count_detections(self, detections):
+        return sum(len(dets) for dets in detections.values())
+
+    def save_result(self, image, detections, filename, stats=None, output_dir=None):
+        stats = stats if stats is not None else ProcessingStats(filename)
+        with stats.stage('render'):
+            result_img = Image.fromarray(self.render(image, detections))
+
+        output_path = os.path.join(output_dir or self.tmp_dir, f"detected_{filename}")
+        with stats.stage('save'):
+            result_img.save(output_path)
+        print(f"Результат сохранен в {output_path}")
+        return result_img
+
+    def detection_groups(self, detections):
+        groups = []
+        color_offset = 0
+        for name, dets in detections.items():
+            names = self.processors[name].model.names
+            groups.append((dets, names, color_offset))
+            color_offset += len(names)
+        return groups
+
+    def render(self, image, detections):
+        canvas = to_rgb(image[:, :])
+        color_offset = 0
+        for name, dets in detections.items():
+            processor = self.processors[name]
+            if len(dets):
+                canvas = processor._render_detections(canvas, dets, color_offset)
+            color_offset += len(processor.model.names)
+        return canvas
+
+    def report_text(self, filename):
+        report = self.reports.get(filename, {})
+        return "\n".join(f"{name}: {count}" for name, count in report.items())
@@ -0,0 +1,75 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class ProcessingStats:
+    # Время по этапам, счетчики (тайлы, батчи, байты) и события для трассировки
+    # обработки одного изображения или кадра.
+    def __init__(self, name=""):
+        self.name = name
+        self.stages = {}
+        self.counters = {}
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, start, time.perf_counter() - start, args)
+
+    def add_stage(self, name, start, duration, args=None):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + duration
+            self.events.append({
+                'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+                'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args or {},
+            })
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        with self._lock:
+            for name, duration in other.stages.items():
+                self.stages[name] = self.stages.get(name, 0.0) + duration
+            for name, value in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            self.events.extend(other.events)
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+    def summary(self):
+        stages = ", ".join(f"{name} {duration:.2f}s" for name, duration in self.stages.items())
+        counters = ", ".join(f"{name} {value}" for name, value in self.counters.items())
+        return f"{self.name}: {stages}" + (f" | {counters}" if counters else "")
+
+    def as_dict(self):
+        return {'name': self.name, 'stages': dict(self.stages), 'counters': dict(self.counters)}
+
+
+def write_chrome_trace(path, stats_list):
+    # формат Trace Event: открывается в chrome://tracing и Perfetto
+    events = []
+    for stats in stats_list:
+        for event in stats.events:
+            events.append(dict(event, cat=stats.name))
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,128 @@
+import os
+import math
+import hashlib
+import numpy as np
+from image_source import open_image, image_size, unlimited_pixels
+
+
+class ImagePyramid:
+    # Уровни изображения, уменьшенного в 2, 4, 8... раз, для просмотра больших сцен.
+    # Уровень 0 - исходный файл, остальные один раз строятся в кэш на диске (.npy)
+    # и открываются через memmap, так что в памяти оказываются только читаемые тайлы.
+    # Размер кэша ограничен cache_limit: вытесняются уровни давно не открывавшихся снимков.
+    def __init__(self, path, tile_size=512, cache_dir='cache/pyramid', chunk_rows=2048,
+                 cache_limit=8 * 2 ** 30):
+        self.path = path
+        self.tile_size = tile_size
+        self.cache_dir = cache_dir
+        self.cache_limit = cache_limit
+        self.chunk_rows = max(2, chunk_rows // 2 * 2)
+        self.width, self.height = image_size(path)
+        self.levels = []
+
+        st = os.stat(path)
+        key = f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}".encode('utf-8')
+        self.key = hashlib.blake2b(key, digest_size=16).hexdigest()
+
+    @property
+    def ready(self):
+        return bool(self.levels)
+
+    @property
+    def top_level(self):
+        return len(self.levels) - 1
+
+    def build(self):
+        # долгая операция при первом открытии файла - вызывается не из GUI-потока
+        os.makedirs(self.cache_dir, exist_ok=True)
+        levels = [self._base_level()]
+        while max(levels[-1].shape[:2]) > self.tile_size:
+            path = os.path.join(self.cache_dir, f"{self.key}_{len(levels)}.npy")
+            if not os.path.exists(path):
+                self._downsample(levels[-1], path)
+            levels.append(np.load(path, mmap_mode='r'))
+        self.levels = levels
+        self._evict()
+        return self
+
+    def _base_level(self):
+        # несжатый TIFF уже отображается в память; остальное декодируется один раз
+        # и сохраняется в кэш, чтобы полный кадр не оставался в памяти на время просмотра
+        path = os.path.join(self.cache_dir, f"{self.key}_0.npy")
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r')
+        with unlimited_pixels():
+            image = open_image(self.path)
+        if not isinstance(image, np.ndarray) or isinstance(image, np.memmap):
+            return image
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, image)
+        del image
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+
+    def _cached_files(self):
+        return [entry for entry in os.scandir(self.cache_dir)
+                if entry.name.endswith('.npy') and entry.is_file()]
+
+    def _evict(self):
+        # время последнего открытия снимка - mtime его уровней
+        scenes = {}
+        for entry in self._cached_files():
+            key = entry.name.rsplit('_', 1)[0]
+            if key == self.key:
+                try:
+                    os.utime(entry.path)
+                except OSError:
+                    pass
+                continue
+            st = entry.stat()
+            scene = scenes.setdefault(key, [0, 0, []])
+            scene[0] = max(scene[0], st.st_mtime_ns)
+            scene[1] += st.st_size
+            scene[2].append(entry.path)
+
+        total = sum(os.path.getsize(entry.path) for entry in self._cached_files())
+        for _, size, paths in sorted(scenes.values()):
+            if total <= self.cache_limit:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    # уровень открыт в другом окне (Windows) - останется до следующего раза
+                    size -= os.path.getsize(path) if os.path.exists(path) else 0
+            total -= size
+
+    def level_for_scale(self, scale):
+        # scale - пикселей экрана на пиксель изображения
+        if scale >= 1 or not self.levels:
+            return 0
+        return min(self.top_level, int(math.floor(math.log2(1 / scale))))
+
+    def grid(self, level):
+        height, width = self.levels[level].shape[:2]
+        return math.ceil(width / self.tile_size), math.ceil(height / self.tile_size)
+
+    def tile(self, level, tx, ty):
+        size = self.tile_size
+        return np.ascontiguousarray(self.levels[level][ty * size:(ty + 1) * size, tx * size:(tx + 1) * size])
+
+    def _downsample(self, source, path):
+        # среднее по блокам 2x2, по полосам строк
+        height, width = source.shape[:2]
+        shape = (math.ceil(height / 2), math.ceil(width / 2)) + source.shape[2:]
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        target = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=shape)
+        for y in range(0, height, self.chunk_rows):
+            strip = np.asarray(source[y:y + self.chunk_rows])
+            pad = ((0, strip.shape[0] % 2), (0, strip.shape[1] % 2)) + ((0, 0),) * (strip.ndim - 2)
+            if strip.shape[0] % 2 or strip.shape[1] % 2:
+                strip = np.pad(strip, pad, mode='edge')
+            blocks = strip.reshape((strip.shape[0] // 2, 2, strip.shape[1] // 2, 2) + strip.shape[2:])
+            target[y // 2:y // 2 + blocks.shape[0]] = blocks.mean(axis=(1, 3), dtype=np.float32) + 0.5
+        target.flush()
+        del target
+        os.replace(tmp_path, path)
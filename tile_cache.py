@@ -0,0 +1,210 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# учитываемый размер записи: ключ и служебные объекты в памяти, блок файловой системы на диске
+ENTRY_OVERHEAD = 256
+FILE_BLOCK = 4096
+
+EMPTY = np.empty((0, 6), dtype=np.float32)
+EMPTY.setflags(write=False)
+
+
+class TileCache:
+    # Сырые предсказания модели для тайла [x1, y1, x2, y2, conf, cls] в координатах тайла.
+    # Ключ - хэш содержимого тайла, веса модели, imgsz и нижний порог доверия,
+    # с которым считались предсказания. Два уровня: LRU в памяти и каталог
+    # .npy-файлов на диске, из которого вытесняются давно не читавшиеся записи.
+    # Тайлы без предсказаний (большинство на РЛИ) не пишутся отдельными файлами:
+    # их ключи дописываются в общий список empty.keys.
+    def __init__(self, directory='cache/tiles', memory_limit=256 * 2 ** 20, disk_limit=2 * 2 ** 30,
+                 min_conf=0.05):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.min_conf = min_conf
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = None
+        self._disk_size = 0
+        self._empty = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_memory=OrderedDict(), _memory_size=0, _disk=None, _disk_size=0, _empty=None, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def model_key(self, model_weights, imgsz):
+        # переобученные веса с тем же именем не должны попадать на старые записи
+        try:
+            st = os.stat(model_weights)
+            weights = f"{os.path.abspath(model_weights)}:{st.st_size}:{st.st_mtime_ns}"
+        except OSError:
+            weights = str(model_weights)
+        return f"{weights}|{imgsz}|{self.min_conf}".encode('utf-8')
+
+    def key(self, tile, model_key):
+        digest = hashlib.blake2b(model_key, digest_size=16)
+        digest.update(str(tile.shape).encode('ascii'))
+        digest.update(np.ascontiguousarray(tile).data)
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return value
+
+            self._scan_disk()
+            path = self._path(key)
+            if key in self._empty:
+                value = EMPTY
+            elif key in self._disk:
+                try:
+                    value = np.load(path)
+                    os.utime(path)
+                except (OSError, ValueError):
+                    self._forget(key)
+                    value = None
+
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, value)
+            return value
+
+    def put(self, key, value):
+        value = np.ascontiguousarray(value, dtype=np.float32)
+        if not len(value):
+            value = EMPTY
+        with self._lock:
+            self._remember(key, value)
+
+            self._scan_disk()
+            if key in self._disk or key in self._empty:
+                return
+            if value is EMPTY:
+                try:
+                    with open(self._empty_path(), 'a', encoding='ascii') as f:
+                        f.write(key + '\n')
+                except OSError as e:
+                    print(f"Не удалось записать кэш тайла: {e}")
+                    return
+                self._empty.add(key)
+                self._disk_size += len(key) + 1
+                if self._disk_size > self.disk_limit:
+                    self._evict_disk()
+                return
+            path = self._path(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, value)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Не удалось записать кэш тайла: {e}")
+                return
+            size = self._file_size(os.path.getsize(path))
+            self._disk[key] = size
+            self._disk_size += size
+            if self._disk_size > self.disk_limit:
+                self._evict_disk()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            self._scan_disk()
+            for key in list(self._disk):
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+                self._forget(key)
+            self._clear_empty()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def _empty_path(self):
+        return os.path.join(self.directory, 'empty.keys')
+
+    def _file_size(self, size):
+        # файл занимает целое число блоков, даже если в нем только заголовок .npy
+        return -(-size // FILE_BLOCK) * FILE_BLOCK
+
+    def _clear_empty(self):
+        try:
+            os.remove(self._empty_path())
+        except OSError:
+            pass
+        self._disk_size -= sum(len(key) + 1 for key in self._empty)
+        self._empty = set()
+
+    def _remember(self, key, value):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = value
+        self._memory_size += value.nbytes + ENTRY_OVERHEAD
+        while self._memory_size > self.memory_limit and len(self._memory) > 1:
+            _, old = self._memory.popitem(last=False)
+            self._memory_size -= old.nbytes + ENTRY_OVERHEAD
+
+    def _scan_disk(self):
+        if self._disk is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._disk = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy'):
+                size = self._file_size(entry.stat().st_size)
+                self._disk[entry.name[:-4]] = size
+                self._disk_size += size
+        try:
+            with open(self._empty_path(), encoding='ascii') as f:
+                self._empty = {line.strip() for line in f if line.strip()}
+        except OSError:
+            self._empty = set()
+        self._disk_size += sum(len(key) + 1 for key in self._empty) + FILE_BLOCK
+
+    def _forget(self, key):
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_size -= size
+
+    def _evict_disk(self):
+        # время последнего чтения хранится в mtime (get обновляет его через utime);
+        # освобождаем место с запасом, чтобы не сканировать каталог на каждой записи
+        entries = []
+        for key in self._disk:
+            try:
+                entries.append((os.stat(self._path(key)).st_mtime_ns, key))
+            except OSError:
+                entries.append((0, key))
+        entries.sort()
+
+        target = self.disk_limit * 0.9
+        for _, key in entries:
+            if self._disk_size <= target:
+                break
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            self._forget(key)
+        # у пустых записей нет времени чтения - список сбрасывается целиком
+        if self._disk_size > target:
+            self._clear_empty()
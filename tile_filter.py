@@ -0,0 +1,104 @@
+import math
+from statistics import NormalDist
+import numpy as np
+
+
+class BlockGrid:
+    # Статистики блоков block x block изображения: сумма, сумма квадратов и максимум.
+    # Считаются векторизованно по полосам строк; extend дочитывает новые полосы,
+    # поэтому сетку можно строить по кадру, который еще принимается.
+    def __init__(self, image, block=8, chunk_rows=1024):
+        self.image = image
+        self.block = block
+        self.chunk_rows = max(block, chunk_rows // block * block)
+        self.height, self.width = image.shape[:2]
+        self.rows = 0
+        self._sums = []
+        self._sq_sums = []
+        self._maxima = []
+        self.sums = self.sq_sums = self.maxima = np.empty((0, math.ceil(self.width / block)), dtype=np.float32)
+
+    def rows_needed(self, y2):
+        # строки, которые нужны для блоков, покрывающих тайл до y2
+        return min(self.height, math.ceil(y2 / self.block) * self.block)
+
+    def extend(self, y2):
+        target = self.rows_needed(y2)
+        if target <= self.rows:
+            return
+        while self.rows < target:
+            y1 = self.rows
+            y2 = min(target, y1 + self.chunk_rows)
+            self._scan(y1, y2)
+            self.rows = y2
+        self.sums = np.concatenate(self._sums)
+        self.sq_sums = np.concatenate(self._sq_sums)
+        self.maxima = np.concatenate(self._maxima)
+        self._sums, self._sq_sums, self._maxima = [self.sums], [self.sq_sums], [self.maxima]
+
+    def _scan(self, y1, y2):
+        strip = np.asarray(self.image[y1:y2, :])
+        if strip.ndim == 3:
+            strip = strip.mean(axis=2, dtype=np.float32)
+
+        # неполные блоки на краях дополняем крайними пикселями
+        pad_y = -strip.shape[0] % self.block
+        pad_x = -strip.shape[1] % self.block
+        if pad_y or pad_x:
+            strip = np.pad(strip, ((0, pad_y), (0, pad_x)), mode='edge')
+
+        blocks = strip.reshape(strip.shape[0] // self.block, self.block, strip.shape[1] // self.block, self.block)
+        if strip.dtype == np.uint8:
+            # целочисленные суммы заметно быстрее, чем через float
+            squares = np.multiply(blocks, blocks, dtype=np.uint16)
+            self._sums.append(blocks.sum(axis=(1, 3), dtype=np.uint32).astype(np.float32))
+            self._sq_sums.append(squares.sum(axis=(1, 3), dtype=np.uint32).astype(np.float32))
+        else:
+            self._sums.append(blocks.sum(axis=(1, 3), dtype=np.float32))
+            self._sq_sums.append(np.square(blocks, dtype=np.float32).sum(axis=(1, 3)))
+        self._maxima.append(blocks.max(axis=(1, 3)).astype(np.float32))
+
+
+class TileFilter:
+    # Отсев тайлов, в которых не может быть целей: однородный фон (малое СКО)
+    # без локальных выбросов. Фон и его разброс оцениваются по нижней части
+    # распределения средних по блокам (квантили low_q и 5%), которую яркие цели
+    # и участки берега не смещают, пока занимают меньше (1 - low_q) тайла.
+    # Выброс - блок ярче фона больше чем на cfar_k СКО фона, или пиксель ярче min_peak.
+    def __init__(self, block=8, min_std=2.0, cfar_k=5.0, min_peak=None, low_q=25, chunk_rows=1024):
+        self.block = block
+        self.min_std = min_std
+        self.cfar_k = cfar_k
+        self.min_peak = min_peak
+        self.low_q = low_q
+        self.chunk_rows = chunk_rows
+        # для нормального распределения: расстояние между квантилями 5% и low_q в СКО
+        self._spread = float(NormalDist().inv_cdf(low_q / 100) - NormalDist().inv_cdf(0.05))
+
+    def grid(self, image):
+        return BlockGrid(image, self.block, self.chunk_rows)
+
+    def keep(self, grid, tiles):
+        # tiles должны лежать в уже прочитанных строках сетки
+        block_pixels = float(self.block * self.block)
+        keep = np.zeros(len(tiles), dtype=bool)
+        for k, (x1, y1, x2, y2) in enumerate(tiles):
+            by1, by2 = y1 // self.block, math.ceil(y2 / self.block)
+            bx1, bx2 = x1 // self.block, math.ceil(x2 / self.block)
+            sums = grid.sums[by1:by2, bx1:bx2]
+
+            count = sums.size * block_pixels
+            mean = sums.sum(dtype=np.float64) / count
+            squares = grid.sq_sums[by1:by2, bx1:bx2].sum(dtype=np.float64)
+            std = math.sqrt(max(squares / count - mean * mean, 0.0))
+            if self.min_peak is not None and grid.maxima[by1:by2, bx1:bx2].max() >= self.min_peak:
+                keep[k] = True
+                continue
+            if std < self.min_std:
+                continue
+
+            low, background = np.percentile(sums, (5, self.low_q)) / block_pixels
+            # не меньше одного уровня яркости, чтобы квантованный ровный фон не давал деления на ноль
+            background_std = max((background - low) / self._spread, 1.0)
+            keep[k] = (sums.max() / block_pixels - background) / background_std >= self.cfar_k
+        return keep
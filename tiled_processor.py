@@ -1,151 +1,541 @@
 import os
 import math
-import torch
+import time
+import itertools
+import threading
+from collections import OrderedDict
+import psutil
 import numpy as np
 from PIL import Image
-from ultralytics import YOLO
+from image_source import open_image, to_rgb, image_params
+from georef import detections_to_geo
+from profiling import ProcessingStats
+
+# torch и ultralytics импортируются при первом обращении к модели,
+# чтобы не задерживать запуск интерфейса
+
+MODEL_PRESETS = {
+    "наземные объекты": dict(model_weights='weights/nano960-9.pt', tile_size=4000, imgsz=960, overlap=100),
+    "большие надводные объекты": dict(model_weights='weights/medium_ships.pt', tile_size=800, imgsz=800, overlap=100),
+    "малые надводные объекты": dict(model_weights='weights/bkr.pt', tile_size=256, imgsz=256, overlap=50),
+}
+
+class RecentFrames(OrderedDict):
+    # Кандидаты последних limit кадров. В непрерывном режиме старые кадры вытесняются
+    # вместе со связанными записями (параметры, отчеты); их детекции остаются в DetectionStore.
+    def __init__(self, limit, linked=()):
+        super().__init__()
+        self.limit = limit
+        self.linked = linked
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.limit:
+            old, _ = self.popitem(last=False)
+            for records in self.linked:
+                records.pop(old, None)
+
+    def clear(self):
+        super().clear()
+        for records in self.linked:
+            records.clear()
+
+    def __reduce__(self):
+        return (self.__class__, (self.limit,), None, None, iter(self.items()))
+
 
 class TiledYOLOProcessor:
-    def __init__(self, model_weights, tile_size=256, imgsz=256, overlap=0):
-        self.model = YOLO(model_weights)
+    def __init__(self, model_weights, tile_size=256, imgsz=256, overlap=0,
+                 iou_threshold=0.1, class_aware=False, nms_grid=False, batch_size=4, cache=None,
+                 floor_conf=0.05, tile_filter=None, cascade=None, cascade_scale=4, cascade_conf=0.1,
+                 roi_margin=64, max_frames=500):
+        self.model_weights = model_weights
+        self._model = None
+        self._lock = threading.RLock()
         self.tile_size = tile_size
         self.imgsz = imgsz
         self.overlap = overlap
+        self.iou_threshold = iou_threshold
+        self.class_aware = class_aware
+        self.nms_grid = nms_grid
+        self.batch_size = batch_size
+        self.cache = cache
+        self.floor_conf = floor_conf
+        self.tile_filter = tile_filter
+        self.cascade = cascade
+        self.cascade_scale = cascade_scale
+        self.cascade_conf = cascade_conf
+        self.roi_margin = roi_margin
+        self.params = {}
+        self.candidates = RecentFrames(max_frames, (self.params,))
+        self._batch_buffer = None
+        self.last_stats = None
+        # размеченные копии изображений; интерфейс рисует рамки поверх исходного
+        # изображения и сохраняет копии только по запросу
+        self.save_images = True
         self.tmp_dir = "tmp"
         os.makedirs(self.tmp_dir, exist_ok=True)
 
-    def process_image(self, image_path, conf=0.25):
-        original_img = Image.open(image_path).convert('RGB')
-        original_width, original_height = original_img.size
-        filename = os.path.basename(image_path)
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from ultralytics import YOLO
+                    self._model = YOLO(self.model_weights)
+        return self._model
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def __getstate__(self):
+        # для пула процессов: веса и буферы в дочернем процессе создаются заново
+        state = self.__dict__.copy()
+        state.update(_model=None, _lock=None, _batch_buffer=None, candidates={}, params={})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def warm_up(self):
+        # загрузка весов и пробный прогон для инициализации ядер
+        with self._lock:
+            if self.batch_size == 'auto':
+                self._resolve_batch_size()
+            else:
+                dummy = np.zeros((self.tile_size, self.tile_size, 3), dtype=np.uint8)
+                self.model([dummy], imgsz=self.imgsz, verbose=False)
+
+    def warm_up_async(self):
+        thread = threading.Thread(target=self.warm_up, daemon=True)
+        thread.start()
+        return thread
+
+    def process_image(self, image, conf=0.25, filename=None, stats=None):
+        stats = stats if stats is not None else ProcessingStats(filename or "")
+        params = image_params(image)
+        if isinstance(image, (str, os.PathLike)):
+            filename = filename or os.path.basename(image)
+            stats.name = filename
+            with stats.stage('decode'):
+                image = open_image(image)
+        if params is not None:
+            self.params[filename] = params
+        
+        candidates = self.detect_candidates(image, conf, stats)
+        self.candidates[filename] = candidates
+        filtered_detections = self.threshold(candidates, conf)
+        result_img = self.save_result(image, filtered_detections, filename, stats) if self.save_images else None
+        self.last_stats = stats
+        return result_img, len(filtered_detections)
+
+    def detect(self, image, conf=0.25, stats=None):
+        return self.threshold(self.detect_candidates(image, conf, stats), conf)
+
+    def detect_candidates(self, image, conf=0.25, stats=None):
+        # Инференс с нижним порогом floor_conf: более высокий порог потом
+        # применяется к сохраненным боксам без повторного прогона модели.
+        # Жадный NMS не зависит от боксов с меньшей уверенностью, поэтому
+        # отсечение по порогу после NMS дает тот же результат, что и до него.
+        stats = stats if stats is not None else ProcessingStats()
+        with self._lock:
+            return self._detect(image, min(conf, self.floor_conf), stats)
+
+    def threshold(self, detections, conf):
+        return detections[detections[:, 4] >= conf]
+
+    def rethreshold(self, filename, conf):
+        return self.threshold(self.candidates[filename], conf)
+
+    def georeference(self, filename, detections):
+        # координаты всех боксов кадра одним вызовом; None, если у снимка нет параметров РЛИ
+        params = self.params.get(filename)
+        return detections_to_geo(detections, params) if params is not None else None
+
+    def _detect(self, image, conf, stats):
+        import torch
+
+        original_height, original_width = image.shape[:2]
         
         tiles = self._generate_tiles(original_width, original_height)
+        tile_shape = (min(self.tile_size, original_height), min(self.tile_size, original_width), 3)
+        stats.count('tiles', len(tiles))
         
-        all_detections = []
+        batch_detections = []
+        # кэш хранит предсказания с его нижним порогом, поэтому годится для conf не ниже этого порога
+        use_cache = self.cache is not None and conf >= self.cache.min_conf
+        if use_cache:
+            model_key = self.cache.model_key(self.model_weights, self.imgsz)
         
-        for i in range(0, len(tiles), 4):
-            batch = tiles[i:i+4]
-            batch_images = []
-            batch_coords = []
+        self._resolve_batch_size()
+        if self.cascade is not None:
+            tiles = self._cascade_tiles(image, tiles, stats)
+        if self.tile_filter is not None:
+            selected = self._select_tiles(image, tiles, stats)
+        else:
+            selected = iter(tiles)
+        while True:
+            batch = list(itertools.islice(selected, self.batch_size))
+            if not batch:
+                break
+            stats.count('batches')
             
-            for x1, y1, x2, y2 in batch:
-                tile = original_img.crop((x1, y1, x2, y2))
-                batch_images.append(np.array(tile))
-                batch_coords.append((x1, y1, x2, y2))
+            if hasattr(image, 'wait_rows'):
+                # кадр еще принимается - ждем строки, нужные этому батчу
+                with stats.stage('wait_rows'):
+                    image.wait_rows(max(y2 for _, _, _, y2 in batch))
             
-            batch_results = self.model(batch_images, imgsz=self.imgsz, conf=conf)
+            # тайлы - окна одного массива (или файла), копируются только в буфер батча;
+            # серые окна расширяются до трех каналов здесь же
+            with stats.stage('crop'):
+                batch_images = self._get_batch_buffer(len(batch), tile_shape)
+                for k, (x1, y1, x2, y2) in enumerate(batch):
+                    window = image[y1:y2, x1:x2]
+                    batch_images[k] = window if window.ndim == 3 else window[..., None]
+            stats.count('tile_bytes', batch_images.nbytes)
             
-            for result, (offset_x, offset_y, tile_x2, tile_y2) in zip(batch_results, batch_coords):
-                if result.boxes is not None:
-                    for box in result.boxes:
-                        box_xyxy = box.xyxy[0].cpu().numpy()
-                        
-                        if self._is_in_overlap_zone(box_xyxy, offset_x, offset_y, tile_x2, tile_y2):
-                            continue
-                        
-                        abs_xyxy = [
-                            box_xyxy[0] + offset_x,
-                            box_xyxy[1] + offset_y,
-                            box_xyxy[2] + offset_x,
-                            box_xyxy[3] + offset_y
-                        ]
-                        
-                        all_detections.append({
-                            'xyxy': abs_xyxy,
-                            'conf': box.conf.item(),
-                            'cls': box.cls.item()
-                        })
+            if use_cache:
+                detections = self._detect_cached(batch_images, batch, conf, model_key, stats)
+            else:
+                with stats.stage('inference', tiles=len(batch)):
+                    batch_results = self._predict(list(batch_images), conf)
+                with stats.stage('collect'):
+                    detections = self._collect_batch(batch_results, batch)
+            if detections is not None:
+                batch_detections.append(detections)
         
-        filtered_detections = self._filter_overlapping_boxes(all_detections)
+        with stats.stage('transfer'):
+            if batch_detections:
+                detections = torch.cat(batch_detections).cpu().numpy()
+            else:
+                detections = np.empty((0, 6), dtype=np.float32)
         
-        result_img = original_img.copy()
-        
-        if filtered_detections:
-            img_np = np.array(result_img)
-            dummy_result = self.model(img_np, imgsz=self.imgsz)[0]
-            
-            boxes = torch.tensor([d['xyxy'] for d in filtered_detections])
-            confs = torch.tensor([d['conf'] for d in filtered_detections])
-            cls = torch.tensor([d['cls'] for d in filtered_detections])
-            
-            dummy_result.boxes.data = torch.cat([
-                boxes,
-                confs.unsqueeze(1),
-                cls.unsqueeze(1)
-            ], dim=1)
-            
-            scale_factor = max(original_width, original_height) / 1000
-            font_size = max(10, int(20 * scale_factor))
-            line_width = max(1, int(2 * scale_factor))
-            
-            plotted_img_np = dummy_result.plot(
-                font_size=font_size,
-                line_width=line_width,
-                pil=False
-            )
-            
-            result_img = Image.fromarray(plotted_img_np)
+        with stats.stage('nms', boxes=len(detections)):
+            keep = self._filter_overlapping_boxes(detections[:, :4], detections[:, 4], detections[:, 5])
+        stats.count('candidates', len(detections))
+        stats.count('detections', len(keep))
+        return detections[keep]
+
+    def _cascade_tiles(self, image, tiles, stats):
+        # Грубый проход: модель cascade на изображении, прореженном в cascade_scale раз,
+        # находит области интереса; мелкие тайлы берутся только там, где они
+        # пересекают расширенные на roi_margin области.
+        height = image.shape[0]
+        if hasattr(image, 'wait_rows'):
+            with stats.stage('wait_rows'):
+                image.wait_rows(height)
+
+        with stats.stage('cascade'):
+            overview = image[::self.cascade_scale, ::self.cascade_scale]
+            rois = self.cascade.detect(overview, self.cascade_conf)[:, :4] * self.cascade_scale
+            margin = self.roi_margin + self.cascade_scale
+            rois = rois + np.array([-margin, -margin, margin, margin], dtype=np.float32)
+
+            coords = np.asarray(tiles, dtype=np.float32).reshape(-1, 4)
+            hit = np.zeros(len(tiles), dtype=bool)
+            for start in range(0, len(rois), 256):
+                part = rois[start:start + 256]
+                hit |= ((coords[:, None, 0] < part[None, :, 2]) & (coords[:, None, 2] > part[None, :, 0]) &
+                        (coords[:, None, 1] < part[None, :, 3]) & (coords[:, None, 3] > part[None, :, 1])).any(axis=1)
+
+        skipped = len(tiles) - int(hit.sum())
+        stats.count('cascade_rois', len(rois))
+        stats.count('tiles_skipped', skipped)
+        print(f"Каскад: областей интереса {len(rois)}, пропущено тайлов {skipped} из {len(tiles)}")
+        return [tile for tile, kept in zip(tiles, hit) if kept]
+
+    def _select_tiles(self, image, tiles, stats):
+        # Тайлы проверяются по рядам: для кадра, который еще принимается,
+        # статистики блоков считаются по мере поступления строк.
+        grid = self.tile_filter.grid(image)
+        skipped = 0
+        for _, row in itertools.groupby(tiles, key=lambda tile: (tile[1], tile[3])):
+            row = list(row)
+            y2 = row[0][3]
+            if hasattr(image, 'wait_rows'):
+                with stats.stage('wait_rows'):
+                    image.wait_rows(grid.rows_needed(y2))
+            with stats.stage('tile_filter'):
+                grid.extend(y2)
+                keep = self.tile_filter.keep(grid, row)
+            skipped += len(row) - int(keep.sum())
+            for tile, kept in zip(row, keep):
+                if kept:
+                    yield tile
+
+        stats.count('tiles_skipped', skipped)
+        print(f"Пропущено пустых тайлов: {skipped} из {len(tiles)} ({skipped / max(len(tiles), 1):.0%})")
+
+    def count_detections(self, detections):
+        return len(detections)
+
+    def save_result(self, image, detections, filename, stats=None, output_dir=None):
+        stats = stats if stats is not None else ProcessingStats(filename)
+        with stats.stage('render'):
+            result_img = Image.fromarray(self.render(image, detections))
         
-        output_path = os.path.join(self.tmp_dir, f"detected_{filename}")
-        result_img.save(output_path)
+        output_path = os.path.join(output_dir or self.tmp_dir, f"detected_{filename}")
+        with stats.stage('save'):
+            result_img.save(output_path)
         print(f"Результат сохранен в {output_path}")
-        return result_img, len(filtered_detections)
+        return result_img
 
-    def _is_in_overlap_zone(self, box_xyxy, offset_x, offset_y, tile_x2, tile_y2):
-        abs_x1 = box_xyxy[0] + offset_x
-        abs_y1 = box_xyxy[1] + offset_y
-        abs_x2 = box_xyxy[2] + offset_x
-        abs_y2 = box_xyxy[3] + offset_y
-        
+    def detection_groups(self, detections):
+        # (боксы, имена классов, сдвиг палитры) для рисования поверх изображения
+        return [(detections, self.model.names, 0)]
+
+    def render(self, image, detections):
+        if len(detections):
+            return self._render_detections(to_rgb(image[:, :]), detections)
+        return np.asarray(image[:, :])
+
+    def _get_batch_buffer(self, size, tile_shape):
+        buffer = self._batch_buffer
+        if buffer is None or buffer.shape[0] < size or buffer.shape[1:] != tile_shape:
+            buffer = np.empty((max(size, self.batch_size),) + tile_shape, dtype=np.uint8)
+            self._batch_buffer = buffer
+        return buffer[:size]
+
+    def _predict(self, batch_images, conf):
+        import torch
+
+        try:
+            return self.model(batch_images, imgsz=self.imgsz, conf=conf)
+        except (torch.cuda.OutOfMemoryError, MemoryError):
+            if len(batch_images) == 1:
+                raise
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            half = len(batch_images) // 2
+            self.batch_size = max(1, min(self.batch_size, half))
+            print(f"Нехватка памяти, размер батча уменьшен до {self.batch_size}")
+            return self._predict(batch_images[:half], conf) + self._predict(batch_images[half:], conf)
+
+    def _resolve_batch_size(self):
+        if self.batch_size == 'auto':
+            self.batch_size = self._probe_batch_size()
+            print(f"Выбран размер батча: {self.batch_size}")
+        return self.batch_size
+
+    def _probe_batch_size(self, max_batch=64, memory_fraction=0.5):
+        # Верхняя граница по свободной памяти, затем удваиваем батч,
+        # пока растет пропускная способность
+        import torch
+
+        dummy = [np.zeros((self.tile_size, self.tile_size, 3), dtype=np.uint8)]
+        cuda = torch.cuda.is_available()
+
+        self.model(dummy, imgsz=self.imgsz, verbose=False)
+        if cuda:
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+            self.model(dummy, imgsz=self.imgsz, verbose=False)
+            per_tile = max(torch.cuda.max_memory_allocated() - base, 1)
+            available = torch.cuda.mem_get_info()[0]
+        else:
+            # грубая оценка: тайл, входной тензор float32 и активации сети
+            per_tile = self.tile_size * self.tile_size * 3 + self.imgsz * self.imgsz * 3 * 4 * 8
+            available = psutil.virtual_memory().available
+        limit = max(1, min(max_batch, int(available * memory_fraction // per_tile)))
+
+        best_size, best_rate = 1, 0.0
+        size = 1
+        while size <= limit:
+            try:
+                start = time.perf_counter()
+                self.model(dummy * size, imgsz=self.imgsz, verbose=False)
+                rate = size / (time.perf_counter() - start)
+            except (torch.cuda.OutOfMemoryError, MemoryError):
+                if cuda:
+                    torch.cuda.empty_cache()
+                break
+            if rate < best_rate * 1.05:
+                break
+            best_size, best_rate = size, rate
+            size *= 2
+        return best_size
+
+    def _render_detections(self, img_np, detections, color_offset=0):
+        # Рисуем итоговые боксы напрямую, тем же оформлением, что и Results.plot
+        from ultralytics.utils.plotting import Annotator, colors
+
+        height, width = img_np.shape[:2]
+        scale_factor = max(width, height) / 1000
+        font_size = max(10, int(20 * scale_factor))
+        line_width = max(1, int(2 * scale_factor))
+
+        names = self.model.names
+        annotator = Annotator(img_np, line_width=line_width, font_size=font_size, pil=False, example=names)
+        for x1, y1, x2, y2, conf, cls in reversed(detections.tolist()):
+            c = int(cls)
+            annotator.box_label((x1, y1, x2, y2), f"{names[c]} {conf:.2f}", color=colors(c + color_offset, True))
+        return annotator.result()
+
+    def _collect_batch(self, batch_results, batch_coords):
+        # Детекции батча одним тензором [x1, y1, x2, y2, conf, cls] в координатах
+        # исходного изображения, без поштучного перебора боксов и синхронизаций.
+        import torch
+
+        parts = []
+        counts = []
+        for result in batch_results:
+            boxes = result.boxes
+            if boxes is None or len(boxes) == 0:
+                counts.append(0)
+                continue
+            counts.append(len(boxes))
+            parts.append(torch.cat([boxes.xyxy, boxes.conf[:, None], boxes.cls[:, None]], dim=1))
+
+        if not parts:
+            return None
+
+        data = torch.cat(parts).float()
+        origins = torch.tensor(batch_coords, dtype=data.dtype, device=data.device)
+        tile_index = torch.repeat_interleave(torch.tensor(counts, device=data.device))
+        tile_coords = origins[tile_index]
+
+        data[:, :4] += tile_coords[:, [0, 1, 0, 1]]
+        return data[self._outside_overlap_zone(data[:, :4], tile_coords)]
+
+    def _detect_cached(self, batch_images, batch_coords, conf, model_key, stats):
+        # В модель уходят только тайлы, которых нет в кэше, с нижним порогом кэша;
+        # порог conf применяется к сохраненным боксам уже здесь.
+        import torch
+
+        with stats.stage('cache'):
+            keys = [self.cache.key(tile, model_key) for tile in batch_images]
+            predictions = [self.cache.get(key) for key in keys]
+        missing = [k for k, tile_predictions in enumerate(predictions) if tile_predictions is None]
+        stats.count('cache_hits', len(keys) - len(missing))
+        stats.count('cache_misses', len(missing))
+
+        if missing:
+            with stats.stage('inference', tiles=len(missing)):
+                batch_results = self._predict([batch_images[k] for k in missing], self.cache.min_conf)
+            with stats.stage('collect'):
+                for k, result in zip(missing, batch_results):
+                    predictions[k] = self._tile_predictions(result)
+                    self.cache.put(keys[k], predictions[k])
+
+        counts = [len(tile_predictions) for tile_predictions in predictions]
+        if not sum(counts):
+            return None
+
+        data = np.concatenate(predictions)
+        tile_coords = np.repeat(np.asarray(batch_coords, dtype=np.float32), counts, axis=0)
+        data[:, :4] += tile_coords[:, [0, 1, 0, 1]]
+        keep = (data[:, 4] >= conf) & self._outside_overlap_zone(data[:, :4], tile_coords)
+        return torch.from_numpy(data[keep])
+
+    def _tile_predictions(self, result):
+        import torch
+
+        boxes = result.boxes
+        if boxes is None or len(boxes) == 0:
+            return np.empty((0, 6), dtype=np.float32)
+        return torch.cat([boxes.xyxy, boxes.conf[:, None], boxes.cls[:, None]], dim=1).float().cpu().numpy()
+
+    def _outside_overlap_zone(self, abs_xyxy, tile_coords):
         overlap_margin = self.overlap // 2
-        left_bound = offset_x + overlap_margin
-        right_bound = tile_x2 - overlap_margin
-        top_bound = offset_y + overlap_margin
-        bottom_bound = tile_y2 - overlap_margin
-        
-        return (abs_x1 < left_bound or abs_x2 > right_bound or 
-                abs_y1 < top_bound or abs_y2 > bottom_bound)
+        return ((abs_xyxy[:, 0] >= tile_coords[:, 0] + overlap_margin) &
+                (abs_xyxy[:, 1] >= tile_coords[:, 1] + overlap_margin) &
+                (abs_xyxy[:, 2] <= tile_coords[:, 2] - overlap_margin) &
+                (abs_xyxy[:, 3] <= tile_coords[:, 3] - overlap_margin))
 
-    def _filter_overlapping_boxes(self, detections):
-        if not detections:
-            return []
-            
-        detections = sorted(detections, key=lambda x: x['conf'], reverse=True)
-        
-        filtered = []
-        used_areas = []
-        
-        for det in detections:
-            x1, y1, x2, y2 = det['xyxy']
-            current_area = (x1, y1, x2, y2)
-            
-            overlap = False
-            for used in used_areas:
-                if self._iou(current_area, used) > 0.1:  
-                    overlap = True
-                    break
-                    
-            if not overlap:
-                filtered.append(det)
-                used_areas.append(current_area)
-                
-        return filtered
+    def _filter_overlapping_boxes(self, boxes, scores, classes):
+        if len(boxes) == 0:
+            return np.empty(0, dtype=np.int64)
 
-    def _iou(self, box1, box2):
-        x_left = max(box1[0], box2[0])
-        y_top = max(box1[1], box2[1])
-        x_right = min(box1[2], box2[2])
-        y_bottom = min(box1[3], box2[3])
-        
-        if x_right < x_left or y_bottom < y_top:
-            return 0.0
-            
-        intersection_area = (x_right - x_left) * (y_bottom - y_top)
-        box1_area = (box1[2] - box1[0]) * (box1[3] - box1[1])
-        box2_area = (box2[2] - box2[0]) * (box2[3] - box2[1])
-        
-        union_area = box1_area + box2_area - intersection_area
-        return intersection_area / union_area if union_area > 0 else 0.0
+        boxes = np.asarray(boxes, dtype=np.float32)
+        scores = np.asarray(scores, dtype=np.float32)
+
+        if self.class_aware:
+            # разносим боксы разных классов, чтобы они не подавляли друг друга
+            shift = boxes.max() - boxes.min() + 1
+            boxes = boxes + (np.asarray(classes, dtype=np.float32) * shift)[:, None]
+
+        if self.nms_grid:
+            return self._nms_grid(boxes, scores)
+        return self._nms(boxes, scores)
+
+    def _nms(self, boxes, scores):
+        order = np.argsort(-scores, kind='stable')
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+        keep = []
+        while order.size:
+            i = order[0]
+            keep.append(i)
+            rest = order[1:]
+            iou = self._iou(boxes[i], areas[i], boxes[rest], areas[rest])
+            order = rest[iou <= self.iou_threshold]
+
+        return np.array(keep, dtype=np.int64)
+
+    def _nms_grid(self, boxes, scores):
+        # Ячейка - наибольшая сторона среди боксов не крупнее удвоенного 99-го
+        # перцентиля: пересекающиеся боксы лежат в соседних ячейках, поэтому
+        # сравниваем только их. Редкие боксы крупнее ячейки в сетку не попадают и
+        # сравниваются со всеми - иначе один большой бокс укрупнил бы ячейки для остальных.
+        n = len(boxes)
+        order = np.argsort(-scores, kind='stable')
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.arange(n)
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+        sides = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+        limit = 2 * float(np.percentile(sides, 99))
+        cell = max(float(sides[sides <= limit].max()), 1.0)
+        large = sides > cell
+        oversized = np.flatnonzero(large)
+        everything = np.arange(n)
+        cx = np.floor((boxes[:, 0] + boxes[:, 2]) / 2 / cell).astype(np.int64)
+        cy = np.floor((boxes[:, 1] + boxes[:, 3]) / 2 / cell).astype(np.int64)
+
+        buckets = {}
+        regular = np.flatnonzero(~large)
+        for idx, key in zip(regular.tolist(), zip(cx[regular].tolist(), cy[regular].tolist())):
+            buckets.setdefault(key, []).append(idx)
+        buckets = {key: np.array(val, dtype=np.int64) for key, val in buckets.items()}
+
+        suppressed = np.zeros(n, dtype=bool)
+        keep = []
+        for i in order:
+            if suppressed[i]:
+                continue
+            keep.append(i)
+
+            if large[i]:
+                candidates = everything
+            else:
+                neighbours = [buckets[(cx[i] + dx, cy[i] + dy)]
+                              for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                              if (cx[i] + dx, cy[i] + dy) in buckets]
+                if oversized.size:
+                    neighbours.append(oversized)
+                candidates = np.concatenate(neighbours)
+            candidates = candidates[(rank[candidates] > rank[i]) & ~suppressed[candidates]]
+            if candidates.size:
+                iou = self._iou(boxes[i], areas[i], boxes[candidates], areas[candidates])
+                suppressed[candidates[iou > self.iou_threshold]] = True
+
+        return np.array(keep, dtype=np.int64)
+
+    def _iou(self, box, area, boxes, areas):
+        x_left = np.maximum(box[0], boxes[:, 0])
+        y_top = np.maximum(box[1], boxes[:, 1])
+        x_right = np.minimum(box[2], boxes[:, 2])
+        y_bottom = np.minimum(box[3], boxes[:, 3])
+
+        intersection_area = np.clip(x_right - x_left, 0, None) * np.clip(y_bottom - y_top, 0, None)
+        union_area = area + areas - intersection_area
+
+        iou = np.zeros_like(intersection_area)
+        np.divide(intersection_area, union_area, out=iou, where=union_area > 0)
+        return iou
 
     def _generate_tiles(self, width, height):
         tiles = []
@@ -1,11 +1,16 @@
 import os
+import math
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from image_source import image_size
 from PyQt5 import uic
-from PyQt5.QtCore import Qt, pyqtSignal, QRectF
+from PyQt5.QtCore import Qt, pyqtSignal, QRectF, QTimer
 from PyQt5.QtGui import QPixmap
 from PyQt5.QtWidgets import QMainWindow, QTableWidget, QTableWidgetItem, \
-    QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QProgressBar, QMessageBox
+    QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGraphicsItem, QProgressBar, QMessageBox
 from PyQt5.QtCore import Qt, QPointF
-from PyQt5.QtGui import QPixmap, QWheelEvent, QMouseEvent
+from PyQt5.QtGui import QPixmap, QImage, QWheelEvent, QMouseEvent, QColor, QPen
 
 
 class MainWindow(QMainWindow):
@@ -32,7 +37,8 @@ class MainWindow(QMainWindow):
         self.start_btn.setEnabled(enabled)
         self.horizontalSlider.setEnabled(enabled)
         for btn in self.buttonGroup.buttons():
-            btn.setEnabled(enabled)
+            btn.setEnabled(enabled and not self.all_models_chbox.isChecked())
+        self.all_models_chbox.setEnabled(enabled)
         self.detected_chbox.setEnabled(enabled)
         
     def update_progress(self, progress: int, filename: str):
@@ -83,12 +89,12 @@ class TableWidget(QTableWidget):
         self.item(row, 0).setFlags(Qt.ItemIsEnabled)
         self.item(row, 1).setFlags(Qt.ItemIsEnabled)
 
-    def update_value(self, file_name, value):
-        row_count = self.rowCount()
-        for i in range(row_count):
-            current_file_name = self.item(i, 0).text()
-            if current_file_name == file_name:
-                self.setItem(i, 1, QTableWidgetItem(str(value)))
+    def update_value(self, file_name, value, details=""):
+        for found in self.findItems(file_name, Qt.MatchExactly):
+            if found.column() == 0:
+                item = QTableWidgetItem(str(value))
+                item.setToolTip(details)
+                self.setItem(found.row(), 1, item)
                 return
 
     def on_cell_double_clicked(self, row, col):
@@ -97,6 +103,9 @@ class TableWidget(QTableWidget):
 
 
 class MyGraphicsView(QGraphicsView):
+    tile_loaded = pyqtSignal(object, tuple, object)
+    pyramid_ready = pyqtSignal(object)
+
     def __init__(self, parent=None):
         super().__init__(parent)
         
@@ -121,7 +130,35 @@ class MyGraphicsView(QGraphicsView):
         self.max_zoom = 20.0
         self.current_scale = 1.0
 
+        # Большие сцены показываются пирамидой: грузятся только видимые тайлы
+        # уровня, соответствующего масштабу, в фоновых потоках.
+        self.pyramid_min_pixels = 16 * 2 ** 20
+        self.pyramid = None
+        self.overlay = None
+        self._tiles = {}
+        self._pending = set()
+        self._loader = ThreadPoolExecutor(max_workers=4)
+        self._update_timer = QTimer(self)
+        self._update_timer.setSingleShot(True)
+        self._update_timer.setInterval(30)
+        self._update_timer.timeout.connect(self.update_tiles)
+        self.horizontalScrollBar().valueChanged.connect(self._update_timer.start)
+        self.verticalScrollBar().valueChanged.connect(self._update_timer.start)
+        self.tile_loaded.connect(self.on_tile_loaded)
+        self.pyramid_ready.connect(self.on_pyramid_ready)
+
     def set_image(self, image_path):
+        self.clear_tiles()
+        self.clear_detections()
+        try:
+            width, height = image_size(image_path)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            print(f"Не удалось прочитать размер изображения {image_path}: {e}")
+            width = height = 0
+        if width * height >= self.pyramid_min_pixels:
+            self.set_pyramid(image_path, width, height)
+            return
+
         pixmap = QPixmap(image_path)
         if pixmap.isNull():
             print("Ошибка загрузки изображения")
@@ -132,6 +169,105 @@ class MyGraphicsView(QGraphicsView):
         self.fitInView(self.pixmap_item, Qt.KeepAspectRatio)
         self.current_scale = 1.0
 
+    def set_detections(self, groups):
+        self.clear_detections()
+        self.overlay = DetectionOverlay(groups, self.sceneRect())
+        self.scene.addItem(self.overlay)
+
+    def clear_detections(self):
+        if self.overlay is not None:
+            self.scene.removeItem(self.overlay)
+            self.overlay = None
+
+    def set_pyramid(self, image_path, width, height):
+        from pyramid import ImagePyramid
+
+        self.pixmap_item.setPixmap(QPixmap())
+        self.pyramid = ImagePyramid(image_path)
+        self.scene.setSceneRect(QRectF(0, 0, width, height))
+        self.fitInView(self.scene.sceneRect(), Qt.KeepAspectRatio)
+        self.current_scale = 1.0
+        self._loader.submit(self._build_pyramid, self.pyramid)
+
+    def clear_tiles(self):
+        for item in self._tiles.values():
+            self.scene.removeItem(item)
+        self._tiles.clear()
+        self._pending.clear()
+        self.pyramid = None
+
+    def _build_pyramid(self, pyramid):
+        try:
+            self.pyramid_ready.emit(pyramid.build())
+        except Exception as e:
+            print(f"Ошибка построения пирамиды {pyramid.path}: {e}")
+
+    def on_pyramid_ready(self, pyramid):
+        if pyramid is not self.pyramid:
+            return
+        # самый грубый уровень загружается целиком и остается подложкой
+        columns, rows = pyramid.grid(pyramid.top_level)
+        for ty in range(rows):
+            for tx in range(columns):
+                self._request_tile((pyramid.top_level, tx, ty))
+        self.update_tiles()
+
+    def update_tiles(self):
+        pyramid = self.pyramid
+        if pyramid is None or not pyramid.ready:
+            return
+
+        level = pyramid.level_for_scale(self.transform().m11())
+        step = pyramid.tile_size * 2 ** level
+        columns, rows = pyramid.grid(level)
+        rect = self.mapToScene(self.viewport().rect()).boundingRect().intersected(self.sceneRect())
+        visible = {
+            (level, tx, ty)
+            for ty in range(max(0, int(rect.top() // step)), min(rows, math.ceil(rect.bottom() / step)))
+            for tx in range(max(0, int(rect.left() // step)), min(columns, math.ceil(rect.right() / step)))
+        }
+
+        for key in list(self._tiles):
+            if key[0] != pyramid.top_level and key not in visible:
+                self.scene.removeItem(self._tiles.pop(key))
+        for key in visible:
+            self._request_tile(key)
+
+    def _request_tile(self, key):
+        if key in self._tiles or key in self._pending:
+            return
+        self._pending.add(key)
+        self._loader.submit(self._load_tile, self.pyramid, key)
+
+    def _load_tile(self, pyramid, key):
+        try:
+            array = pyramid.tile(*key)
+            height, width = array.shape[:2]
+            image_format = QImage.Format_RGB888 if array.ndim == 3 else QImage.Format_Grayscale8
+            image = QImage(array.data, width, height, array.strides[0], image_format).copy()
+            self.tile_loaded.emit(pyramid, key, image)
+        except Exception as e:
+            print(f"Ошибка загрузки тайла {key}: {e}")
+
+    def on_tile_loaded(self, pyramid, key, image):
+        if pyramid is not self.pyramid or key not in self._pending:
+            return
+        self._pending.discard(key)
+        level, tx, ty = key
+        step = pyramid.tile_size * 2 ** level
+
+        item = QGraphicsPixmapItem(QPixmap.fromImage(image))
+        item.setPos(tx * step, ty * step)
+        item.setScale(2 ** level)
+        # более детальные уровни поверх грубых
+        item.setZValue(-1 - level)
+        self.scene.addItem(item)
+        self._tiles[key] = item
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._update_timer.start()
+
     def wheelEvent(self, event: QWheelEvent):
         zoom_in = event.angleDelta().y() > 0
         
@@ -141,6 +277,7 @@ class MyGraphicsView(QGraphicsView):
         elif not zoom_in and self.current_scale > self.min_zoom:
             self.scale(1 / self.zoom_factor, 1 / self.zoom_factor)
             self.current_scale /= self.zoom_factor
+        self._update_timer.start()
 
     def mousePressEvent(self, event: QMouseEvent):
         if event.button() == Qt.RightButton:
@@ -166,3 +303,54 @@ class MyGraphicsView(QGraphicsView):
         else:
             super().mouseReleaseEvent(event)
 
+
+class DetectionOverlay(QGraphicsItem):
+    # Рамки детекций поверх изображения. Рисуются из массивов боксов и только
+    # в видимой области; толщина линий и подписи не зависят от масштаба.
+    max_labels = 300
+
+    def __init__(self, groups, rect):
+        super().__init__()
+        self.rect = rect
+        boxes, labels, colors = [], [], []
+        for detections, names, color_offset in groups:
+            for x1, y1, x2, y2, conf, cls in detections.tolist():
+                boxes.append((x1, y1, x2, y2))
+                labels.append(f"{names[int(cls)]} {conf:.2f}")
+                colors.append(int(cls) + color_offset)
+        self.boxes = np.array(boxes, dtype=np.float32).reshape(-1, 4)
+        self.labels = labels
+        self.colors = np.array(colors, dtype=np.int64)
+        self.setZValue(10)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        return self.rect
+
+    def paint(self, painter, option, widget=None):
+        exposed = option.exposedRect
+        visible = np.flatnonzero(
+            (self.boxes[:, 2] >= exposed.left()) & (self.boxes[:, 0] <= exposed.right()) &
+            (self.boxes[:, 3] >= exposed.top()) & (self.boxes[:, 1] <= exposed.bottom()))
+
+        for color in np.unique(self.colors[visible]):
+            pen = QPen(self.color(color), 2)
+            pen.setCosmetic(True)
+            painter.setPen(pen)
+            painter.drawRects([QRectF(x1, y1, x2 - x1, y2 - y1)
+                               for x1, y1, x2, y2 in self.boxes[visible[self.colors[visible] == color]].tolist()])
+
+        if len(visible) > self.max_labels:
+            return
+        transform = painter.worldTransform()
+        painter.save()
+        painter.resetTransform()
+        for i in visible.tolist():
+            point = transform.map(QPointF(self.boxes[i, 0], self.boxes[i, 1]))
+            painter.setPen(self.color(self.colors[i]))
+            painter.drawText(point + QPointF(0, -3), self.labels[i])
+        painter.restore()
+
+    @staticmethod
+    def color(index):
+        return QColor.fromHsv(int(index * 137.508) % 360, 220, 255)